@@ -1,23 +1,81 @@
 $(window).ready(function () {
-    // Make an inverse closure, i.e. the ancestors of any node.
-    graph.inverse_closure = {};
-    $.each(graph.transitive_closure, function(parent, descendants) {
-        $.each(descendants, function(child, _) {
-            if(! graph.inverse_closure[child]) {
-                graph.inverse_closure[child] = {};
-            }
-            graph.inverse_closure[child][parent] = true;
+    var prepareGraph = function() {
+        // The closure may be sent as lists of positions in a node list, to keep the page small.
+        if (graph.closure_encoding === 'compact') {
+            var closure = {};
+            $.each(graph.transitive_closure, function(i, descendants) {
+                closure[graph.nodes[i]] = {};
+                $.each(descendants, function(_, j) {
+                    closure[graph.nodes[i]][graph.nodes[j]] = true;
+                });
+            });
+            graph.transitive_closure = closure;
+        }
+
+        // Make an inverse closure, i.e. the ancestors of any node. Only needed if the closure is inlined.
+        if (graph.transitive_closure) {
+            graph.inverse_closure = {};
+            $.each(graph.transitive_closure, function(parent, descendants) {
+                $.each(descendants, function(child, _) {
+                    if(! graph.inverse_closure[child]) {
+                        graph.inverse_closure[child] = {};
+                    }
+                    graph.inverse_closure[child][parent] = true;
+                });
+            });
+        }
+    };
+    prepareGraph();
+
+    var showGraph = function(update) {
+        graph = update.graph;
+        prepareGraph();
+        // Leave out the XML prolog and doctype Graphviz starts with
+        $('body > svg').replaceWith(update.svg.substring(update.svg.indexOf('<svg')));
+    };
+
+    // When the files behind the page change, the server sends the new graph. Swap it in.
+    if (graph.events_url && window.EventSource) {
+        new EventSource(graph.events_url).addEventListener('update', function(e) {
+            showGraph(JSON.parse(e.data));
         });
-    });
+    }
+
+    // Calls back with the ancestors or descendants of target, asking the server if the closure isn't inlined.
+    var withRelatives = function(target, upwards, callback) {
+        if (! graph.closure_url) {
+            var closure = upwards ? graph.inverse_closure : graph.transitive_closure;
+            callback(closure[target] || {});
+            return;
+        }
+
+        // Asked of the page's own graph, as focused and collapsed
+        var url = graph.closure_url + '/' + (upwards ? 'ancestors' : 'descendants') + '/' + encodeURIComponent(target) +
+            (graph.closure_query ? '?' + graph.closure_query : '');
+        $.getJSON(url, function(data) {
+            var relatives = {};
+            $.each(data.nodes, function(_, node) {
+                relatives[node] = true;
+            });
+            callback(relatives);
+        });
+    };
 
-    $('g.node').click(function (e) {
+    // Handlers are delegated, so they keep working when the graph is swapped
+    $(document).on('click', 'g.node', function (e) {
         var target = e.currentTarget.id;
 
+        // Collapsed subgraphs are swapped for a layout of what's in them
+        if (graph.collapsed && graph.collapsed[target]) {
+            $.getJSON(graph.expand_url + '&node=' + encodeURIComponent(target), showGraph);
+            e.preventDefault();
+            return false;
+        }
+
         // Use shift to add new highlights, without dimming the ones already highlighted
         var additive = e.shiftKey;
         // Use the alt-key to change direction, i.e. highlight ancestors instead of descendants.
         var upwards = e.altKey;
-        var closure = upwards ? graph.inverse_closure : graph.transitive_closure;
 
         if(! additive) {
             $('.selected').removeClass('selected');
@@ -25,38 +83,38 @@ $(window).ready(function () {
 
         $(e.currentTarget).addClass('selected');
 
-        $('g.node').each(function (i, node) {
-            var nodeId = node.id;
-            if (nodeId === target ||
-                (closure[target] && closure[target][node.id])
-            ) {
-                $(node).removeClass("ignore").addClass("highlight");
-            } else {
-                if(! additive) {
-                    $(node).addClass("ignore").removeClass("highlight");
+        withRelatives(target, upwards, function(relatives) {
+            $('g.node').each(function (i, node) {
+                var nodeId = node.id;
+                if (nodeId === target || relatives[nodeId]) {
+                    $(node).removeClass("ignore").addClass("highlight");
+                } else {
+                    if(! additive) {
+                        $(node).addClass("ignore").removeClass("highlight");
+                    }
                 }
-            }
-        });
+            });
 
-        $('g.edge').each(function (i, edge) {
-            var edgeId = edge.id;
-            var parts = edgeId.split("/");
-            var start = parts[0];
-            var end = parts[1];
+            $('g.edge').each(function (i, edge) {
+                var edgeId = edge.id;
+                var parts = edgeId.split("/");
+                var start = parts[0];
+                var end = parts[1];
+
+                var include = (
+                    upwards && (end === target) || // If we're going up and the edge targets us, include it
+                    !upwards && (start === target) || // Conversely, if we're going down and we're the start
+                    (relatives[start] && relatives[end]) // The edge exists between ancestors/descendants
+                );
 
-            var include = (
-                upwards && (end === target) || // If we're going up and the edge targets us, include it
-                !upwards && (start === target) || // Conversely, if we're going down and we're the start
-                (closure[target] && closure[target][start] && closure[target][end]) // The edge exists between ancestors/descendants
-            );
-
-            if(include) {
-                $(edge).removeClass("ignore").addClass("highlight");
-            } else {
-                if(! additive) {
-                    $(edge).addClass("ignore").removeClass("highlight");
+                if(include) {
+                    $(edge).removeClass("ignore").addClass("highlight");
+                } else {
+                    if(! additive) {
+                        $(edge).addClass("ignore").removeClass("highlight");
+                    }
                 }
-            }
+            });
         });
 
         e.preventDefault();
@@ -64,7 +122,7 @@ $(window).ready(function () {
     });
 
     // When hovering over an edge or a node, display comments if some have been provided
-    $('g.node, g.edge').mouseover(function(e) {
+    $(document).on('mouseover', 'g.node, g.edge', function(e) {
         var target = e.currentTarget.id,
             description = $(e.currentTarget).find('a').first().attr('xlink:title'),
             header = target;
@@ -84,7 +142,7 @@ $(window).ready(function () {
         $('.hover .description').html(window.markdownit().render(description));
     });
 
-    $('g.node, g.edge').mouseout(function(e) {
+    $(document).on('mouseout', 'g.node, g.edge', function(e) {
         $('.hover').hide();
     });
 
@@ -6,20 +6,37 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import array
+import bisect
 import collections
+import contextlib
+import ctypes
+import ctypes.util
+import glob
+import hashlib
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import platform
 import random
 import re
+import select
+import shutil
+import signal
+import subprocess
 import sys
+import tempfile
+import timeit
+import threading
+import time
 import unittest
+import zlib
+from multiprocessing.pool import ThreadPool
 
-import flask
-import networkx
-import sh
-from networkx.algorithms import dag, tree
-from pyparsing import *
+# flask, networkx, pyparsing and sh take a while to import, and most runs only need some of
+# them, if any. They're imported where they're used.
 
 logger = logging.getLogger(__name__)
 
@@ -49,43 +66,247 @@ def err(l): sys.stderr.write(l + '\n')
 # Edges can be entities too:
 # ..attr: a --> b, Label: fill=red :: Comment
 
-header = Suppress('..') + oneOf('subgraph attr allPaths ancestors descendants')('directive') + Suppress(':')
-Identifier = lambda name: Word(alphanums + '._-')(name)
-edge = Identifier('start') + Suppress('-->') + Identifier('end')
-
-entity = edge | Identifier('node')
-labelledEntity = (entity + Suppress(',') + Regex('[^:]+')('label'))
-entityDetails = labelledEntity | entity
-
-comment = Regex('.*')('comment')
-data = MatchFirst((
-    # Either everything up to a :: and everything that follows after it as a comment
-    SkipTo(Literal('::'))('data') + Suppress('::') + comment,
-    # ... or simply the rest of the line if there is no comment
-    Regex('.*')('data')
-))
+# Things that take a while to make are made the first time they're needed, under this lock
+_lazy_lock = threading.RLock()
+_reference_parser = None
+
+
+def reference_parser():
+    """ Returns the pyparsing grammar, built the first time it's asked for. """
+    global _reference_parser
+    with _lazy_lock:
+        if _reference_parser is None:
+            _reference_parser = _build_reference_parser()
+    return _reference_parser
+
+
+def _build_reference_parser():
+    from pyparsing import Literal, MatchFirst, Regex, SkipTo, Suppress, Word, alphanums, oneOf
+
+    header = Suppress('..') + oneOf('subgraph attr allPaths ancestors descendants')('directive') + Suppress(':')
+    Identifier = lambda name: Word(alphanums + '._-')(name)
+    edge = Identifier('start') + Suppress('-->') + Identifier('end')
+
+    entity = edge | Identifier('node')
+    labelledEntity = (entity + Suppress(',') + Regex('[^:]+')('label'))
+    entityDetails = labelledEntity | entity
+
+    comment = Regex('.*')('comment')
+    data = MatchFirst((
+        # Either everything up to a :: and everything that follows after it as a comment
+        SkipTo(Literal('::'))('data') + Suppress('::') + comment,
+        # ... or simply the rest of the line if there is no comment
+        Regex('.*')('data')
+    ))
+
+    directive = header + entityDetails + Suppress(':') + data
+    edgeSpec = MatchFirst((
+        edge + Suppress('::') + comment,
+        edge
+    ))
+
+    return directive | edgeSpec
+
+
+# The pyparsing grammar is the reference definition of the language, but
+# scanning every line with it is slow: searchString attempts a full parse at every
+# character offset. The scanner below is a compiled regular expression that finds
+# the exact same statements. Most input lines contain neither an edge nor a
+# directive, so those are rejected before the regular expression is even tried.
+
+_ws = '[ \\t\\r\\n]*'
+
+def _identifier(name):
+    # Like pyparsing's Word, identifiers are matched greedily and never backtracked into.
+    # Python's re has no atomic groups, so emulate one with a lookahead and a backreference.
+    return '(?=(?P<{0}>[A-Za-z0-9._-]+))(?P={0})'.format(name)
+
+_directive_pattern = (
+    '\\.\\.' + _ws + '(?P<directive>subgraph|attr|allPaths|ancestors|descendants)' + _ws + ':' + _ws +
+    '(?:' + _identifier('directive_start') + _ws + '-->' + _ws + _identifier('directive_end') + '|' + _identifier('node') + ')' +
+    '(?:' + _ws + ',' + _ws + '(?P<label>[^: \\t\\r\\n][^:]*))?' + _ws + ':' + _ws +
+    '(?:(?P<data>.*?)::' + _ws + '(?P<directive_comment>.*)|(?P<rest>.*))'
+)
+_edge_pattern = (
+    _identifier('start') + _ws + '-->' + _ws + _identifier('end') +
+    '(?:' + _ws + '::' + _ws + '(?P<comment>.*))?'
+)
+scanner = re.compile(_directive_pattern + '|' + _edge_pattern)
+
+
+def _statement_from_match(match):
+    groups = match.groupdict()
+    if groups['directive'] is None:
+        statement = dict(start=groups['start'], end=groups['end'])
+        if groups['comment'] is not None:
+            statement['comment'] = groups['comment']
+        return statement
+
+    statement = dict(directive=groups['directive'])
+    if groups['node'] is not None:
+        statement['node'] = groups['node']
+    else:
+        statement['start'] = groups['directive_start']
+        statement['end'] = groups['directive_end']
+    if groups['label'] is not None:
+        statement['label'] = groups['label']
+    if groups['rest'] is not None:
+        statement['data'] = groups['rest']
+    else:
+        statement['data'] = groups['data']
+        statement['comment'] = groups['directive_comment']
+    return statement
+
+
+def scan_for_statements(line):
+    """ Returns all statements found in a line, using the fast scanner. """
+    if '-->' not in line and '..' not in line:
+        return []
+    if '\t' in line:
+        # pyparsing expands tabs before parsing, which shows in labels, data and comments
+        line = line.expandtabs()
+    return [_statement_from_match(match) for match in scanner.finditer(line)]
+
+
+def parse_for_statements(line):
+    """ Returns all statements found in a line, using the reference pyparsing grammar. """
+    return [
+        dict(r) for r in reference_parser().searchString(line)
+    ]
 
-directive = header + entityDetails + Suppress(':') + data
-edgeSpec = MatchFirst((
-    edge + Suppress('::') + comment,
-    edge
-))
 
-parser = directive | edgeSpec
+statement_engines = {
+    "scanner": scan_for_statements,
+    "pyparsing": parse_for_statements,
+}
 
 
-def search_for_statements(line):
+def search_for_statements(line, engine="scanner"):
     """ Returns all statements found in a line. """
-    return [
-        dict(r) for r in parser.searchString(line)
-    ]
+    return statement_engines[engine](line)
+
+
+def iter_statements(lines, engine="scanner"):
+    """ Yields all statements found in lines, in order. """
+    for line in lines:
+        for statement in search_for_statements(line, engine):
+            yield statement
+
+
+def _parse_chunk(chunk_and_engine):
+    chunk, engine = chunk_and_engine
+    return list(iter_statements(chunk, engine))
+
+
+def parse_lines_in_parallel(lines, jobs=0, engine="scanner", chunk_size=10000):
+    """ Yields all statements found in lines, parsing chunks of lines in a pool of jobs processes.
+
+    Statements come in the same order as a sequential parse would find them. Lines are only read
+    as the pool has room for them, so just a few chunks are held at once. Zero jobs means one per core.
+    Errors reading lines are raised here, once the statements before them have been yielded.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    remaining_lines = iter(lines)
+    # Parses in progress, oldest first
+    pending = collections.deque()
+    exhausted = False
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        while True:
+            # Lines are read here rather than in the pool's own thread, which would swallow their errors
+            while not exhausted and len(pending) < 2 * jobs:
+                chunk = list(itertools.islice(remaining_lines, chunk_size))
+                if chunk:
+                    pending.append(pool.apply_async(_parse_chunk, [(chunk, engine)]))
+                else:
+                    exhausted = True
+            if not pending:
+                return
+            for statement in pending.popleft().get():
+                yield statement
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parse_lines(lines, engine="scanner", jobs=1):
+    """ Yields all statements found in lines. With more than one job (or 0 for one per core), lines
+    are parsed in parallel. """
+    if jobs == 1:
+        return iter_statements(lines, engine)
+    return parse_lines_in_parallel(lines, jobs, engine)
+
+
+def installed(program):
+    """ Is program on the PATH? """
+    paths = [os.path.join(directory, program) for directory in os.environ.get("PATH", "").split(os.pathsep)]
+    return any(os.path.isfile(path) and os.access(path, os.X_OK) for path in paths)
+
+
+def iter_lines(f):
+    """ Yields the lines of a binary file object as they can be read, decoded and without line endings. """
+    for line in iter(f.readline, b''):
+        yield (line[:-1] if line.endswith(b'\n') else line).decode('utf-8')
+
+
+class SourceTimeout(Exception):
+    pass
+
+
+def stream_command(command, timeout=None, cwd=None):
+    """ Yields the lines a shell command outputs, as it outputs them. It runs in cwd, if given.
+
+    If the command runs for longer than timeout seconds, it and anything it started is killed,
+    and SourceTimeout is raised.
+    """
+    # A session of its own lets us kill whatever the command starts as well
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, preexec_fn=os.setsid, cwd=cwd)
+    timed_out = []
+
+    def kill():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            # Already gone
+            pass
+
+    def time_out():
+        timed_out.append(True)
+        kill()
+
+    timer = threading.Timer(timeout, time_out) if timeout else None
+    if timer:
+        timer.daemon = True
+        timer.start()
+
+    try:
+        for line in iter_lines(process.stdout):
+            yield line
+    except GeneratorExit:
+        # Nobody wants the rest of the output
+        kill()
+        raise
+    finally:
+        if timer:
+            timer.cancel()
+        process.stdout.close()
+        process.wait()
+
+    if timed_out:
+        raise SourceTimeout("[{}] timed out after {} seconds".format(command, timeout))
+    if process.returncode:
+        # Like os.popen, we don't mind how it exits.
+        logger.warning("[{}] exited with {}".format(command, process.returncode))
 
 
 class ParserTests(unittest.TestCase):
 
     def assertParsedEquals(self, input, expectedData):
-        parsed = parser.parseString(input)
+        parsed = reference_parser().parseString(input)
         self.assertEqual(dict(parsed), expectedData) #, "Unexpected result for [{}]".format(input))
+        # The scanner must agree with the reference grammar
+        self.assertEqual(scan_for_statements(input)[:1], [expectedData])
 
     def test_edge_parser(self):
         expectedForInput = {
@@ -161,30 +382,716 @@ class ParserTests(unittest.TestCase):
         }
 
         for input, expectedResult in expectedForInput.items():
-            self.assertEqual(search_for_statements(input), expectedResult)
+            for engine in statement_engines:
+                self.assertEqual(search_for_statements(input, engine), expectedResult)
+
+    def test_scanner_agrees_with_pyparsing(self):
+        # Glue random fragments together and make sure both engines find the same statements
+        fragments = [
+            '..attr:', '..subgraph:', '.. attr :', '..descendants:', '..', 'a', 'b.c', 'x-y', '-->', ' --> ', '--->',
+            ' ', '\t', ',', ', ', ':', ' :: ', ':::', 'Label', '# ', '*'
+        ]
+        rng = random.Random(42)
+        for i in range(2000):
+            line = ''.join(rng.choice(fragments) for _ in range(rng.randint(1, 10)))
+            self.assertEqual(scan_for_statements(line), parse_for_statements(line), "Engines disagree on [{}]".format(line))
+
+
+def _bit_positions(bits):
+    """ Yields the positions of the set bits in bits, lowest first.
+
+    >>> list(_bit_positions(0b10110))
+    [1, 2, 4]
+    """
+    digits = bin(bits)[:1:-1]
+    position = digits.find('1')
+    while position != -1:
+        yield position
+        position = digits.find('1', position + 1)
+
+
+def _strongly_connected_components(succ):
+    """ Returns the strongly connected components of a graph given as successor lists, as lists of
+    nodes. Components come sinks first, i.e. in reverse topological order.
+
+    This is Tarjan's algorithm, with an explicit stack so deep graphs don't hit the recursion limit.
+    """
+    index_of = [-1] * len(succ)
+    lowest = [0] * len(succ)
+    on_stack = [False] * len(succ)
+    stack = []
+    components = []
+    counter = 0
+
+    for root in range(len(succ)):
+        if index_of[root] != -1:
+            continue
+        index_of[root] = lowest[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, 0)]
+
+        while work:
+            node, i = work[-1]
+            if i < len(succ[node]):
+                work[-1] = (node, i + 1)
+                successor = succ[node][i]
+                if index_of[successor] == -1:
+                    index_of[successor] = lowest[successor] = counter
+                    counter += 1
+                    stack.append(successor)
+                    on_stack[successor] = True
+                    work.append((successor, 0))
+                elif on_stack[successor]:
+                    lowest[node] = min(lowest[node], index_of[successor])
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowest[parent] = min(lowest[parent], lowest[node])
+            if lowest[node] == index_of[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+
+    return components
+
+
+def _bfs_distances(adjacency, source):
+    """ Returns the number of hops from source to every node reachable from it. """
+    distances = {source: 0}
+    frontier = [source]
+    while frontier:
+        next_frontier = []
+        for node in frontier:
+            for neighbour in adjacency[node]:
+                if neighbour not in distances:
+                    distances[neighbour] = distances[node] + 1
+                    next_frontier.append(neighbour)
+        frontier = next_frontier
+    return distances
+
+
+class CompactGraph(object):
+    """ A directed graph, plus a forest over the same nodes, that's cheap to hold and traverse.
+
+    Node ids are interned to consecutive integers, and edges are kept as arrays of integers per node.
+    Only nodes and edges that have data get a dict. The forest is kept apart from the edges, as an
+    array with the parent of every node.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.index = {}
+        self.succ = []
+        self.pred = []
+        self.edge_keys = set()
+        self.edge_data = {}
+        self.node_data = {}
+        self.parent = array.array(str('l'))
+        self.children = {}
+        self.forest_conflicts = []
+        # Bumped on every change
+        self.version = 0
+
+    @classmethod
+    def from_networkx(cls, g):
+        core = cls()
+        for node in g:
+            core.intern(node)
+        for start, end, data in g.edges(data=True):
+            core.add_edge(start, end, data)
+        return core
+
+    def intern(self, node_id):
+        """ Returns the integer node_id is known by, adding the node if it's new. """
+        i = self.index.get(node_id)
+        if i is None:
+            i = self.index[node_id] = len(self.ids)
+            self.ids.append(node_id)
+            self.succ.append(array.array(str('l')))
+            self.pred.append(array.array(str('l')))
+            self.parent.append(-1)
+            self.version += 1
+        return i
+
+    def __contains__(self, node_id):
+        return node_id in self.index
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def number_of_edges(self):
+        return len(self.edge_keys)
+
+    def add_edge(self, start, end, data=None):
+        a, b = self.intern(start), self.intern(end)
+        key = (a << 32) | b
+        if key not in self.edge_keys:
+            self.edge_keys.add(key)
+            self.succ[a].append(b)
+            self.pred[b].append(a)
+        if data:
+            self.edge_data.setdefault(key, {}).update(data)
+        self.version += 1
+
+    def has_edge(self, start, end):
+        return start in self.index and end in self.index and \
+            ((self.index[start] << 32) | self.index[end]) in self.edge_keys
+
+    def edges(self, data=False):
+        """ Yields (start, end) or (start, end, data) for every edge, in the order nodes were added. """
+        ids = self.ids
+        for a, successors in enumerate(self.succ):
+            for b in successors:
+                if data:
+                    yield ids[a], ids[b], self.edge_data.get((a << 32) | b, {})
+                else:
+                    yield ids[a], ids[b]
+
+    def data(self, node_id):
+        """ Returns the data of a node, without adding one. """
+        return self.node_data.get(self.index.get(node_id), {})
+
+    def update_data(self, node_id, **kwargs):
+        self.node_data.setdefault(self.intern(node_id), {}).update(kwargs)
+        self.version += 1
+
+    def degree(self, node_id):
+        i = self.index[node_id]
+        return len(self.succ[i]) + len(self.pred[i])
+
+    def set_parent(self, child, parent):
+        """ Puts child under parent in the forest. Nodes can only have one parent: conflicting parents
+        are remembered, and make is_forest() false. """
+        c, p = self.intern(child), self.intern(parent)
+        if self.parent[c] == p:
+            return
+        if self.parent[c] != -1:
+            self.forest_conflicts.append((child, parent))
+            return
+        self.parent[c] = p
+        self.children.setdefault(p, array.array(str('l'))).append(c)
+        self.version += 1
+
+    def parent_of(self, node_id):
+        p = self.parent[self.index[node_id]]
+        return None if p == -1 else self.ids[p]
+
+    def children_of(self, node_id):
+        return [self.ids[c] for c in self.children.get(self.index[node_id], ())]
+
+    def forest_edges(self):
+        """ Yields (parent, child) for every node with a parent. """
+        for c, p in enumerate(self.parent):
+            if p != -1:
+                yield self.ids[p], self.ids[c]
+
+    def neighbourhood(self, node_id, depth=None, direction="both"):
+        """ Returns the nodes at most depth edges away from node_id, following edges down, up or both ways. """
+        adjacencies = {"down": (self.succ,), "up": (self.pred,), "both": (self.succ, self.pred)}[direction]
+        start = self.index[node_id]
+        seen = set([start])
+        frontier = [start]
+        hops = 0
+        while frontier and (depth is None or hops < depth):
+            next_frontier = []
+            for node in frontier:
+                for adjacency in adjacencies:
+                    for neighbour in adjacency[node]:
+                        if neighbour not in seen:
+                            seen.add(neighbour)
+                            next_frontier.append(neighbour)
+            frontier = next_frontier
+            hops += 1
+        return set(self.ids[i] for i in seen)
+
+    def induced(self, nodes):
+        """ Returns a graph of only nodes, the edges between them, and the subgraphs enclosing them. """
+        keep = set(self.index[node_id] for node_id in nodes)
+        for i in list(keep):
+            parent = self.parent[i]
+            while parent != -1 and parent not in keep:
+                keep.add(parent)
+                parent = self.parent[parent]
+
+        core = CompactGraph()
+        kept = sorted(keep)
+        for i in kept:
+            core.intern(self.ids[i])
+            if i in self.node_data:
+                core.update_data(self.ids[i], **self.node_data[i])
+        for i in kept:
+            for j in self.succ[i]:
+                if j in keep:
+                    core.add_edge(self.ids[i], self.ids[j], self.edge_data.get((i << 32) | j))
+            for child in self.children.get(i, ()):
+                if child in keep:
+                    core.set_parent(self.ids[child], self.ids[i])
+        core.forest_conflicts.extend(self.forest_conflicts)
+        return core
+
+    def depths(self):
+        """ Returns how many ancestors every node has in the forest, by node id. """
+        depths = {}
+        stack = [(i, 0) for i, parent in enumerate(self.parent) if parent == -1]
+        while stack:
+            i, depth = stack.pop()
+            depths[self.ids[i]] = depth
+            stack.extend((child, depth + 1) for child in self.children.get(i, ()))
+        return depths
+
+    def below(self, node_id):
+        """ Returns everything under node_id in the forest. """
+        found = []
+        stack = list(self.children.get(self.index[node_id], ()))
+        while stack:
+            i = stack.pop()
+            found.append(self.ids[i])
+            stack.extend(self.children.get(i, ()))
+        return found
+
+    def collapse(self, clusters, include_everything=False):
+        """ Returns a graph where each of clusters, with everything under it in the forest, is a single node.
+
+        Edges to and from what's in a cluster go to the cluster, and edges within one are left out. Also
+        returns how many edges each edge to or from a cluster stands for, and how many of the nodes that
+        aren't subgraphs each cluster stands for. Nodes without edges only count with include_everything,
+        as that's when they're rendered.
+        """
+        collapsed = set(self.index[node_id] for node_id in clusters)
+        # What each node is shown as: itself, or the outermost cluster it's in
+        shown = array.array(str('l'), range(len(self.ids)))
+        stack = [i for i, parent in enumerate(self.parent) if parent == -1]
+        while stack:
+            i = stack.pop()
+            for child in self.children.get(i, ()):
+                if shown[i] != i or i in collapsed:
+                    shown[child] = shown[i]
+                stack.append(child)
+
+        core = CompactGraph()
+        members = collections.Counter()
+        for i, node_id in enumerate(self.ids):
+            if shown[i] != i:
+                if not self.node_data.get(i, {}).get('subgraph') and (include_everything or self.succ[i] or self.pred[i]):
+                    members[self.ids[shown[i]]] += 1
+                continue
+            core.intern(node_id)
+            data = dict(self.node_data.get(i, {}))
+            if i in collapsed:
+                data.pop('subgraph', None)
+            if data:
+                core.update_data(node_id, **data)
+        for i, parent in enumerate(self.parent):
+            if shown[i] == i and parent != -1:
+                core.set_parent(self.ids[i], self.ids[parent])
+
+        counts = collections.OrderedDict()
+        for a, successors in enumerate(self.succ):
+            for b in successors:
+                start, end = shown[a], shown[b]
+                if start == end and start in collapsed:
+                    continue
+                if (start, end) == (a, b):
+                    core.add_edge(self.ids[a], self.ids[b], self.edge_data.get((a << 32) | b))
+                else:
+                    key = self.ids[start], self.ids[end]
+                    counts[key] = counts.get(key, 0) + 1
+                    core.add_edge(key[0], key[1])
+        return core, counts, dict(members)
+
+    def is_forest(self):
+        if self.forest_conflicts:
+            return False
+
+        # Nodes can't be their own ancestors
+        checked = set()
+        for start in range(len(self.ids)):
+            path = set()
+            node = start
+            while node != -1 and node not in checked:
+                if node in path:
+                    return False
+                path.add(node)
+                node = self.parent[node]
+            checked.update(path)
+        return True
+
+    def to_networkx(self):
+        """ Returns the graph as a networkx.DiGraph, with the forest as edges marked is_subgraph_relation. """
+        import networkx
+        g = networkx.DiGraph()
+        for i, node_id in enumerate(self.ids):
+            g.add_node(node_id, **self.node_data.get(i, {}))
+        for start, end, data in self.edges(data=True):
+            g.add_edge(start, end, **data)
+        for parent, child in self.forest_edges():
+            g.add_edge(parent, child, is_subgraph_relation=True)
+        return g
+
+
+class ReachabilityIndex(object):
+    """ Answers ancestor/descendant queries for a graph without traversing it again.
+
+    Strongly connected components are condensed into a DAG, and the components reachable from
+    each component are kept as an integer bitset over the components' topological order.
+    """
+
+    def __init__(self, g):
+        if not isinstance(g, CompactGraph):
+            g = CompactGraph.from_networkx(g)
+        self.g = g
+
+        self.members = _strongly_connected_components(g.succ)[::-1]
+        self.component_of = array.array(str('l'), [0] * len(g))
+        for position, members in enumerate(self.members):
+            for member in members:
+                self.component_of[member] = position
+
+        def neighbours(adjacency, position):
+            return set(self.component_of[n] for member in self.members[position] for n in adjacency[member]) - set([position])
+
+        self.successors = [neighbours(g.succ, position) for position in range(len(self.members))]
+
+        self.descendant_bits = [0] * len(self.members)
+        for position in reversed(range(len(self.members))):
+            bits = 0
+            for successor in self.successors[position]:
+                bits |= (1 << successor) | self.descendant_bits[successor]
+            self.descendant_bits[position] = bits
+
+        self.ancestor_bits = [0] * len(self.members)
+        for position in range(len(self.members)):
+            bits = 0
+            for predecessor in neighbours(g.pred, position):
+                bits |= (1 << predecessor) | self.ancestor_bits[predecessor]
+            self.ancestor_bits[position] = bits
+
+    def redundant_edges(self):
+        """ Returns the edges that other paths make redundant, i.e. what a transitive reduction removes.
+
+        Edges within a cycle are kept, as are edges between two cycles unless they're implied
+        by a path through other components.
+        """
+        redundant = set()
+        for start, successors in enumerate(self.g.succ):
+            a = self.component_of[start]
+            for end in successors:
+                b = self.component_of[end]
+                if a == b:
+                    continue
+                # Anything reachable from one of a's successors can be reached without a direct edge
+                if any(self.descendant_bits[successor] >> b & 1 for successor in self.successors[a]):
+                    redundant.add((self.g.ids[start], self.g.ids[end]))
+        return redundant
+
+    def _expand(self, i, bits):
+        # Other members of a node's own component are both its ancestors and descendants
+        nodes = set(self.members[self.component_of[i]])
+        nodes.discard(i)
+        for component in _bit_positions(bits):
+            nodes.update(self.members[component])
+        return nodes
+
+    def _descendants(self, i):
+        return self._expand(i, self.descendant_bits[self.component_of[i]])
+
+    def _ancestors(self, i):
+        return self._expand(i, self.ancestor_bits[self.component_of[i]])
+
+    def descendants(self, node):
+        """ Returns the nodes reachable from node, like networkx.descendants. """
+        return set(self.g.ids[i] for i in self._descendants(self.g.index[node]))
+
+    def ancestors(self, node):
+        """ Returns the nodes node can be reached from, like networkx.ancestors. """
+        return set(self.g.ids[i] for i in self._ancestors(self.g.index[node]))
+
+    def reaches(self, start, end):
+        """ Is there a path from start to end? """
+        a, b = self.component_of[self.g.index[start]], self.component_of[self.g.index[end]]
+        return (a == b and (start != end or len(self.members[a]) > 1 or self.g.has_edge(start, start))) or \
+            bool(self.descendant_bits[a] >> b & 1)
+
+    def _closure_of(self, i):
+        # The transitive closure has self-loops only where the graph does
+        closure = self._descendants(i)
+        if self.g.has_edge(self.g.ids[i], self.g.ids[i]):
+            closure.add(i)
+        return closure
+
+    def closure(self):
+        """ Returns the transitive closure as a dict of dicts, like networkx.transitive_closure(g).succ. """
+        ids = self.g.ids
+        return dict(
+            (node, dict((ids[other], {}) for other in self._closure_of(i)))
+            for i, node in enumerate(ids)
+        )
+
+    def compact_closure(self):
+        """ Returns the transitive closure with nodes referred to by their position in a node list. """
+        order = sorted(range(len(self.g)), key=self.g.ids.__getitem__)
+        position = dict((i, p) for p, i in enumerate(order))
+        return {
+            "closure_encoding": "compact",
+            "nodes": [self.g.ids[i] for i in order],
+            "transitive_closure": [sorted(position[other] for other in self._closure_of(i)) for i in order]
+        }
+
+    def propagate(self, seeds, direction):
+        """ Returns the marks that reach each node from many nodes at once, in one pass over the components.
+
+        seeds maps nodes to integer marks, e.g. a bit per style. Each node gets the bitwise or of the marks
+        of the nodes it's a descendant of, or with direction "ancestors", an ancestor of.
+        """
+        seed_of = dict((self.g.index[node], marks) for node, marks in seeds.items())
+        own = [0] * len(self.members)
+        for i, marks in seed_of.items():
+            own[self.component_of[i]] |= marks
+
+        # Components are in topological order, so a component's predecessors are done before it
+        inherited = [0] * len(self.members)
+        if direction == "ancestors":
+            for position in reversed(range(len(self.members))):
+                for successor in self.successors[position]:
+                    inherited[position] |= inherited[successor] | own[successor]
+        else:
+            for position in range(len(self.members)):
+                for successor in self.successors[position]:
+                    inherited[successor] |= inherited[position] | own[position]
+
+        reached = {}
+        for position, members in enumerate(self.members):
+            # Like _expand(), a seed reaches the rest of its component, but not itself
+            before, marks = [], 0
+            for member in members:
+                before.append(marks)
+                marks |= seed_of.get(member, 0)
+            after = 0
+            for member, marks_before in reversed(list(zip(members, before))):
+                marks = inherited[position] | marks_before | after
+                if marks:
+                    reached[self.g.ids[member]] = marks
+                after |= seed_of.get(member, 0)
+        return reached
+
+    def nodes_between(self, start, end):
+        """ Returns start, end and all nodes on any path from start to end. """
+        a, b = self.g.index[start], self.g.index[end]
+        nodes = set([a, b])
+        if self.reaches(start, end):
+            nodes.update(self._descendants(a) & self._ancestors(b))
+        return set(self.g.ids[i] for i in nodes)
+
+    def _on_shortest_paths(self, b, from_start, to_end):
+        length = from_start.get(b)
+        if length is None:
+            return set()
+        return set(self.g.ids[i] for i, distance in from_start.items() if i in to_end and distance + to_end[i] == length)
+
+    def shortest_paths_of(self, pairs):
+        """ Returns the nodes on the shortest paths between each (start, end) of pairs, or an empty set where
+        there's no path. Searches once from each start and each end, however many pairs share them. """
+        from_starts, to_ends = {}, {}
+        found = []
+        for start, end in pairs:
+            if start == end:
+                found.append(set([start]))
+                continue
+            a, b = self.g.index[start], self.g.index[end]
+            if a not in from_starts:
+                from_starts[a] = _bfs_distances(self.g.succ, a)
+            if b not in to_ends:
+                to_ends[b] = _bfs_distances(self.g.pred, b)
+            found.append(self._on_shortest_paths(b, from_starts[a], to_ends[b]))
+        return found
+
+
+def _literal_prefix(source):
+    """ Returns text that anything the regular expression source matches must start with.
+
+    The prefix can be shorter than it could be, but never too long.
+    """
+    if '|' in source or '(?' in source:
+        # Alternatives or flags could change the meaning of what comes first
+        return ''
+
+    prefix = []
+    i = 0
+    while i < len(source):
+        if source.startswith('[.]', i) or source.startswith('\\.', i):
+            char, width = '.', 3 if source[i] == '[' else 2
+        elif source[i].isalnum() or source[i] in '_-/: ':
+            char, width = source[i], 1
+        else:
+            break
+        if source[i + width:i + width + 1] in ('*', '+', '?', '{'):
+            # The character is optional or repeated
+            break
+        prefix.append(char)
+        i += width
+    return ''.join(prefix)
+
+
+class SubgraphPatterns(object):
+    """ Subgraph children that are patterns rather than node ids, such as `svc.*` or `/db[0-9]+/`.
+
+    Patterns are indexed by the literal prefix every match must start with, so a node is only tried
+    against patterns it could match. Patterns and nodes are remembered once matched, so each pair is
+    only ever tried once as the graph grows.
+    """
+
+    def __init__(self):
+        self.by_prefix = collections.defaultdict(list)
+        self.new_patterns = []
+        self.known_nodes = set()
+
+    @staticmethod
+    def is_pattern(child):
+        return '*' in child or re.match('^/.*/$', child)
+
+    def add(self, parent, child):
+        pattern = re.compile(child.strip("/") if re.match('^/.*/$', child) else child.replace('.', '[.]').replace('*', '.*'))
+        self.new_patterns.append((parent, pattern, _literal_prefix(pattern.pattern)))
+
+    def match(self, nodes):
+        """ Returns (parent, node) for every node matching a pattern of parent, that hasn't been returned before. """
+        memberships = []
+
+        # Nodes we haven't seen are tried against the patterns we already had
+        for node in nodes:
+            if node in self.known_nodes:
+                continue
+            for length in range(len(node) + 1):
+                for parent, pattern in self.by_prefix.get(node[:length], ()):
+                    if node != parent and pattern.match(node):
+                        memberships.append((parent, node))
+
+        # ... and new patterns against every node that has their prefix
+        if self.new_patterns:
+            ordered = sorted(nodes)
+            for parent, pattern, prefix in self.new_patterns:
+                for node in ordered[bisect.bisect_left(ordered, prefix):]:
+                    if not node.startswith(prefix):
+                        break
+                    if node != parent and pattern.match(node):
+                        memberships.append((parent, node))
+                self.by_prefix[prefix].append((parent, pattern))
+            self.new_patterns = []
+
+        self.known_nodes.update(nodes)
+        return memberships
+
+
+# Directives that style nodes by how they're connected to other nodes
+STYLE_DIRECTIVES = ("ancestors", "descendants", "allPaths")
+
+_attr_separators = re.compile('[\\s;,]*')
+_attr_id = re.compile('"(?:[^"\\\\]|\\\\.)*"|<|[^\\s=;,"<]+')
+_attr_equals = re.compile('\\s*=\\s*')
+
+
+def _attr_id_at(text, position):
+    # Graphviz IDs are quoted strings, HTML strings in <>s, or bare words. Returns the one at position and where it ends.
+    match = _attr_id.match(text, position)
+    if match is None:
+        # Nothing we understand, so the rest is kept as it is
+        return text[position:], len(text)
+    if match.group() != '<':
+        return match.group(), match.end()
+    depth, end = 0, position
+    while end < len(text):
+        depth += {'<': 1, '>': -1}.get(text[end], 0)
+        end += 1
+        if depth == 0:
+            break
+    return text[position:end], end
+
+
+def parse_attrs(text):
+    """ Returns the attributes in a Graphviz attribute list as an ordered dict. Values are kept as they're
+    written, quotes and all. A NODE_STYLES name is its style, and STYLE_ALIASES such as !critical are
+    replaced by what they stand for. Anything else that's not key=value is a key without a value.
+
+    >>> [str(key) for key in parse_attrs('shape=box; label="a; b" !low')]
+    ['shape', 'label', 'color', 'style']
+    """
+    text = NODE_STYLES.get(text.strip(), text)
+    attrs = collections.OrderedDict()
+    position = _attr_separators.match(text).end()
+    while position < len(text):
+        key, position = _attr_id_at(text, position)
+        value = None
+        equals = _attr_equals.match(text, position)
+        if equals:
+            value, position = _attr_id_at(text, equals.end())
+        if value is None and key.startswith('!') and key[1:] in STYLE_ALIASES:
+            attrs.update(parse_attrs(STYLE_ALIASES[key[1:]]))
+        else:
+            attrs[key] = value
+        position = _attr_separators.match(text, position).end()
+    return attrs
+
+
+def format_attrs(attrs):
+    """ Returns attrs, as parse_attrs() makes them, as a Graphviz attribute list. """
+    return "; ".join(key if value is None else "{}={}".format(key, value) for key, value in attrs.items())
 
 
 class Graph(object):
 
     def __init__(self, include_everything=False):
-        self.g = networkx.DiGraph()
-        self.subgraphs = networkx.DiGraph()
+        self.core = CompactGraph()
         self.include_everything = include_everything
-        self.graph_attrs = list()
-        self.node_attrs = collections.defaultdict(dict)
-        self.edge_attrs = collections.defaultdict(lambda: collections.defaultdict(list))
-
-        self.path_styles = list()
-        self.ascendant_styles = list()
-        self.descendant_styles = list()
+        self.graph_attrs = collections.OrderedDict()
+        self.subgraph_patterns = SubgraphPatterns()
+        # Attributes are kept as parse_attrs() makes them
+        self.node_attrs = {}
+        self.edge_attrs = {}
+
+        # (directive, node or (start, end), attrs) for each ancestors, descendants and allPaths statement
+        self.style_directives = list()
+        # Styles resolved in another graph, such as the one a focused graph was taken from
+        self.inherited_styles = {}
+        # How many nodes each collapsed subgraph stands for
+        self.summaries = {}
+
+        self._memo = {}
+
+    @property
+    def g(self):
+        """ The graph as a networkx.DiGraph, with subgraph relations as edges marked is_subgraph_relation. """
+        return self._memoized('networkx', self.core.to_networkx)
 
     def include_statement(self, statement):
-        if 'start' in statement:
+        if statement.get('directive') in STYLE_DIRECTIVES:
+            self._handle_style_statement(statement)
+        elif 'start' in statement:
             self._handle_edge_statement(statement)
         else:
             self._handle_node_statement(statement)
 
+    def include_statements(self, statements):
+        """ Includes many statements at once. """
+        for statement in statements:
+            self.include_statement(statement)
+
     def _handle_edge_statement(self, statement):
+        start, end, kwargs = self._edge_from_statement(statement)
+        self.core.add_edge(start, end, kwargs)
+
+    def _edge_from_statement(self, statement):
         # This could be both an edge- and an attr statement with an edge
         if statement.get('directive', 'attr') != 'attr':
             raise ValueError("Can only handle edges for attr statements, not [{}]".format(statement['directive']))
@@ -194,14 +1101,14 @@ class Graph(object):
         data = statement.get('data')
 
         if data:
-            self.edge_attrs[start][end].extend(data.strip().split(";"))
+            self.edge_attrs.setdefault((start, end), collections.OrderedDict()).update(parse_attrs(data))
 
         kwargs = {
             key: statement[key] for key in ('comment', 'label')
             if statement.get(key)
         }
 
-        self.g.add_edge(start, end, **kwargs)
+        return start, end, kwargs
 
     def _handle_node_statement(self, statement):
         directive = statement['directive']
@@ -212,11 +1119,20 @@ class Graph(object):
 
         elif directive == 'attr':
             if node_id == 'graph':
-                self.graph_attrs.append(statement['data'])
+                self.graph_attrs.update(parse_attrs(statement['data']))
             else:
-                self.node_attrs[node_id] = statement['data']
+                self.node_attrs[node_id] = parse_attrs(statement['data'])
                 if statement.get('comment'):
-                    self.node_attrs[node_id] = 'tooltip={}'.format(json.dumps(statement['comment'])) + statement['data']
+                    self.node_attrs[node_id] = collections.OrderedDict([("tooltip", json.dumps(statement['comment']))] + list(self.node_attrs[node_id].items()))
+
+    def _handle_style_statement(self, statement):
+        directive = statement['directive']
+        if (directive == 'allPaths') != ('start' in statement):
+            raise ValueError("allPaths takes an edge, and {} a node, not [{}]".format(
+                "ancestors and descendants" if directive == 'allPaths' else directive, statement.get('node') or statement['start']
+            ))
+        target = (statement['start'], statement['end']) if directive == 'allPaths' else statement['node']
+        self.style_directives.append((directive, target, parse_attrs(statement.get('data', ''))))
 
     def _handle_subgraph(self, statement):
         children = re.split(' *, *', statement['data'])
@@ -224,157 +1140,270 @@ class Graph(object):
 
         for child in children:
             if child:
-                self.g.add_edge(subgraph_id, child, is_subgraph_relation=True)
+                self.core.set_parent(child, subgraph_id)
+                if SubgraphPatterns.is_pattern(child):
+                    self.subgraph_patterns.add(subgraph_id, child)
 
         kwargs = dict(subgraph=True)
         label = statement.get('label')
         if label:
             kwargs['label'] = label
 
-        self.g.node[subgraph_id].update(**kwargs)
+        self.core.update_data(subgraph_id, **kwargs)
 
     @classmethod
-    def from_lines(cls, lines, **kw):
+    def from_lines(cls, lines, engine="scanner", jobs=1, **kw):
+        """ Makes a graph from the statements in lines, which can be any iterable. With more than
+        one job (or 0 for one per core), lines are parsed in parallel as the graph is built. """
         graph = Graph(**kw)
-        for line in lines:
-            for statement in search_for_statements(line):
-                graph.include_statement(statement)
+        graph.include_statements(parse_lines(lines, engine, jobs))
         return graph
 
     @classmethod
     def from_string(cls, string, **kw):
         return cls.from_lines(string.split('\n'), **kw)
 
-    def render_node(self, node_id):
-        return '"{0}" [id="{0}"; {1}];'.format(node_id, self.node_attrs.get(node_id, 'label="{}"'.format(node_id.rsplit(".", 1)[-1])))
-
-    def render_dot(self):
-        dot = ['digraph G {']
-
-        # Graph attributes need to be defined right on the top-level graph
-        if self.graph_attrs:
-            dot.append("; ".join(self.graph_attrs) + ";")
-
-        # Process any subgraph relations. These define subgraphs (within subgraphs within ...)
-        subgraphs = networkx.DiGraph()
-        for a, b, edge_data in self.g.edges(data=True):
-            if edge_data.get('is_subgraph_relation'):
-                subgraphs.add_edge(a, b)
-
-                # If the target is a pattern, add a relation to all edges matching that pattern
-                if '*' in b or re.match('^/.*/$', b):
-                    child_pattern = re.compile(b.strip("/") if re.match('^/.*/$', b) else b.replace('.', '[.]').replace('*', '.*'))
-                    for other_node in self.g:
-                        if other_node != a and child_pattern.match(other_node):
-                            self.g.add_edge(a, other_node, is_subgraph_relation=True)
+    def render_node(self, node_id, styles):
+        attrs = format_attrs(styles.get(node_id, {}))
+        if node_id not in self.node_attrs:
+            # Nodes without attrs of their own are labelled with the last part of their id
+            attrs = 'label="{}"'.format(node_id.rsplit(".", 1)[-1]) + (attrs and "; " + attrs)
+        return '"{0}" [id="{0}"; {1}];'.format(node_id, attrs)
+
+    def propagated_styles(self):
+        """ Returns the attributes ancestors, descendants and allPaths directives give nodes, as ordered dicts by node.
+
+        All the directives are resolved together, with one pass over the components of the graph for each
+        direction, and one search from each end of the paths. Where directives set the same attribute, the
+        one given last wins. Directives about nodes that aren't in the graph are left out.
+        """
+        styles = dict((node_id, collections.OrderedDict(attrs)) for node_id, attrs in self.inherited_styles.items())
+        if not self.style_directives:
+            return styles
+
+        reachability = self.reachability()
+        seeds = {"ancestors": collections.defaultdict(int), "descendants": collections.defaultdict(int)}
+        paths = []
+        for rank, (directive, target, _) in enumerate(self.style_directives):
+            if directive == 'allPaths':
+                if target[0] in self.core and target[1] in self.core:
+                    paths.append((rank, target))
+            elif target in self.core:
+                seeds[directive][target] |= 1 << rank
+
+        # A bit per directive, by node
+        reached = collections.defaultdict(int)
+        for direction, direction_seeds in sorted(seeds.items()):
+            if direction_seeds:
+                for node_id, marks in reachability.propagate(direction_seeds, direction).items():
+                    reached[node_id] |= marks
+        for (rank, _), nodes in zip(paths, reachability.shortest_paths_of(target for _, target in paths)):
+            for node_id in nodes:
+                reached[node_id] |= 1 << rank
+
+        for node_id, marks in reached.items():
+            attrs = styles.setdefault(node_id, collections.OrderedDict())
+            for rank in _bit_positions(marks):
+                attrs.update(self.style_directives[rank][2])
+        return styles
+
+    def node_styles(self):
+        """ Returns the attributes of every node that has any, as ordered dicts by node. A node's own attrs
+        override what it gets from propagated_styles(). """
+        styles = self.propagated_styles()
+        for node_id, attrs in self.node_attrs.items():
+            styles.setdefault(node_id, collections.OrderedDict()).update(attrs)
+        return styles
+
+    def render_dot(self, apply_transitive_reduction=False, positions=None):
+        """ Returns the graph as DOT. positions can give nodes a pos attribute, as LayoutMemory.recall() returns. """
+        return ''.join(self.iter_dot(apply_transitive_reduction, positions))
+
+    def iter_dot(self, apply_transitive_reduction=False, positions=None):
+        """ Returns an iterator of the graph as DOT, a line at a time, so it can be written out as it's made.
+
+        The graph is checked before this returns, so what's wrong with it is raised here, and not by
+        whatever reads the lines, which may be a thread that can't do anything about it.
+        """
+        self.resolve_subgraph_patterns()
 
         # Each subgraph must be a tree, a subgraph can't be withing two other subgraphs
-        if subgraphs and not tree.is_forest(subgraphs):
+        if not self.core.is_forest():
             raise ValueError("subgraph mappings must result in trees")
 
-        for ancestor_spec in self.ascendant_styles:
-            node_id, attrs = re.match('([^ ]+) *: *(.*)', ancestor_spec).groups()
-            attrs = NODE_STYLES.get(attrs, attrs)
-            for ancestor in networkx.ancestors(self.g, node_id):
-                self.node_attrs[ancestor] = attrs + ';' + self.node_attrs.get(ancestor, '')
-
-        for descendant_spec in self.descendant_styles:
-            node_id, attrs = re.match('([^ ]+) *: *(.*)', descendant_spec).groups()
-            attrs = NODE_STYLES.get(attrs, attrs)
-            for descendant in networkx.descendants(self.g, node_id):
-                self.node_attrs[descendant] = attrs + ';' + self.node_attrs.get(descendant, '')
+        styles = self.node_styles()
+        redundant_edges = self.redundant_edges() if apply_transitive_reduction else ()
+        return self._iter_dot_lines(styles, redundant_edges, positions)
 
-        for path_style_spec in self.path_styles:
-            start, end, attrs = re.match('([^ ]+) to ([^ ]+) *: *(.*)', path_style_spec).groups()
-            attrs = NODE_STYLES.get(attrs, attrs)
+    def _iter_dot_lines(self, styles, redundant_edges, positions):
+        yield 'digraph G {\n'
 
-            for nodes_in_path in networkx.all_shortest_paths(self.g, start, end):
-                for node in nodes_in_path:
-                    self.node_attrs[node] = attrs + ';' + self.node_attrs.get(node, '')
+        # Graph attributes need to be defined right on the top-level graph
+        if self.graph_attrs:
+            yield format_attrs(self.graph_attrs) + ";\n"
 
+        # Top-level subgraphs, in the order they were defined. Nested ones are rendered within them.
         already_visited = set()
-        for node in dag.topological_sort(subgraphs):
-            if node in already_visited: continue
-            already_visited.add(node)
-            if self.g.node[node].get('subgraph'):
-                dot.append(self.render_subgraph(node, already_visited))
+        for node_id in self.core:
+            if self.core.data(node_id).get('subgraph') and self.core.parent_of(node_id) is None \
+                    and self.core.children_of(node_id):
+                already_visited.add(node_id)
+                for line in self.iter_subgraph(node_id, already_visited, styles):
+                    yield line
 
         # Edges can be defined wherever.
-        for a, b in self.g.edges():
-            edge_data = self.g.succ[a][b]
-            if edge_data.get('is_subgraph_relation'):
+        for a, b, edge_data in self.core.edges(data=True):
+            if (a, b) in redundant_edges:
                 continue
 
-            attrs = ['id="{0}/{1}"'.format(a, b)] + self.edge_attrs[a][b]
+            attrs = ['id="{0}/{1}"'.format(a, b)]
+            if (a, b) in self.edge_attrs:
+                attrs.append(format_attrs(self.edge_attrs[a, b]))
             if edge_data.get("comment"):
                 attrs.append("tooltip={}".format(json.dumps(edge_data["comment"])))
             if edge_data.get("label"):
                 attrs.append("label={}".format(json.dumps(edge_data["label"])))
 
-            dot.append('"{0}" -> "{1}" [{2}]'.format(a, b, "; ".join(attrs)))
+            yield '"{0}" -> "{1}" [{2}]\n'.format(a, b, "; ".join(attrs))
 
-        for node_id, data in self.g.nodes(data=True):
+        for node_id in self.core:
             if node_id in already_visited:
                 # Node has been part of a subgraph
                 continue
             if self.should_include_node(node_id):
-                dot.append(self.render_node(node_id))
+                yield self.render_node(node_id, styles) + '\n'
 
-        dot.append('}')
+        # Positions are added to the nodes already declared, wherever they are
+        for node_id, pos in sorted((positions or {}).items()):
+            if node_id in self.core and self.should_include_node(node_id):
+                yield '"{}" [pos="{}"];\n'.format(node_id, pos)
 
-        for i, line in enumerate(dot):
-            for alias, replacement in STYLE_ALIASES.items():
-                if alias in line:
-                    line = line.replace('!' + alias, replacement)
-            dot[i] = line
+        yield '}'
 
-        # Grapviz is sensitive to redundant ;s
-        return '\n'.join(dot).replace(";;", ";")
+    def edge_signatures(self):
+        """ Returns a digest of the edges of every node, to tell which nodes' edges have changed. """
+        return dict(
+            (node_id, hashlib.sha1(json.dumps([sorted(self.core.ids[j] for j in adjacency[i]) for adjacency in (self.core.succ, self.core.pred)]).encode("utf8")).hexdigest()[:16])
+            for i, node_id in enumerate(self.core.ids)
+        )
+
+    def resolve_subgraph_patterns(self):
+        """ Adds the nodes matching a subgraph's patterns to the subgraph. """
+        for parent, node in self.subgraph_patterns.match(list(self.core)):
+            self.core.set_parent(node, parent)
 
     def should_include_node(self, node_id):
-        # Only render a node if it has at least one edge going in or out that's _not_ a subgraph relation
-        return self.include_everything or self.g.out_degree(node_id) or any(
-            not data.get('is_subgraph_relation', False) for _, _, data in self.g.in_edges(node_id, data=True)
-        )
+        # Only render a node if it has at least one edge going in or out. Subgraph relations aren't edges.
+        # Collapsed subgraphs are always there, so they can be expanded.
+        return self.include_everything or self.core.degree(node_id) > 0 or node_id in self.summaries
 
-    def render_subgraph(self, root, already_visited):
+    def iter_subgraph(self, root, already_visited, styles):
         # Subgraph ids must be prefixed with "cluster_" to be clustered in the renderers,
         # and they cannot contain dots
-        dot = ['subgraph cluster_{} '.format(root.replace(".", "_")) + '{', 'id="{}";'.format(root)]
+        yield 'subgraph cluster_{} '.format(root.replace(".", "_")) + '{\n'
+        yield 'id="{}";\n'.format(root)
 
-        subgraph_attrs = self.node_attrs.get(root, "")
+        subgraph_attrs = format_attrs(styles.get(root, {}))
         if subgraph_attrs:
-            dot.append(subgraph_attrs)
+            yield subgraph_attrs + ";\n"
 
-        label = self.g.node[root].get("label", '')
-        dot.append('label="{}"; style=dashed;'.format(label))
+        label = self.core.data(root).get("label", '')
+        yield 'label="{}"; style=dashed;\n'.format(label)
 
-        for child in self.g[root]:
+        for child in self.core.children_of(root):
             if child in already_visited: continue
-            if self.g.node[child].get('subgraph'):
-                subsub = self.render_subgraph(child, already_visited)
-                dot.append(subsub)
+            if self.core.data(child).get('subgraph'):
+                for line in self.iter_subgraph(child, already_visited, styles):
+                    yield line
             else:
                 if self.should_include_node(child):
-                    dot.append(self.render_node(child))
+                    yield self.render_node(child, styles) + '\n'
             already_visited.add(child)
 
-        dot.append('}')
-
-        return '\n'.join(dot)
-
-    def get_graph_data(self):
-        ancestors_by_node = {}
-        descendants_by_node = {}
-
-        for node in self.g:
-            ancestors_by_node[node] = list(networkx.ancestors(self.g, node))
-            descendants_by_node[node] = list(networkx.descendants(self.g, node))
-
-        return {
-            "transitive_closure": dict(networkx.transitive_closure(self.g).succ._atlas),
-            "edges": dict(self.g.succ._atlas)
+        yield '}\n'
+
+    def neighbourhood(self, node_id, depth=None, direction="both"):
+        """ Returns the nodes at most depth edges away from node_id. direction is down, up, or both. """
+        return self.core.neighbourhood(node_id, depth, direction)
+
+    def between(self, start, end):
+        """ Returns start, end and the nodes on any path between them. """
+        return self.reachability().nodes_between(start, end)
+
+    def focus(self, nodes):
+        """ Returns a graph of only nodes and the edges between them, within the subgraphs that enclose them.
+
+        The nodes were picked, so they're rendered even when none of their edges are.
+        """
+        self.resolve_subgraph_patterns()
+        focused = Graph(include_everything=True)
+        focused.core = self.core.induced(nodes)
+        focused.graph_attrs = collections.OrderedDict(self.graph_attrs)
+        focused.node_attrs.update(self.node_attrs)
+        # Styles follow from the whole graph, not just what's in focus
+        focused.inherited_styles = self.propagated_styles()
+        focused.edge_attrs = self.edge_attrs
+        return focused
+
+    def collapse(self, clusters):
+        """ Returns a graph where each subgraph of clusters is a single node, with the edges of all that's in it.
+        Edges that stand for several are labelled with how many. """
+        self.resolve_subgraph_patterns()
+        collapsed = Graph(include_everything=self.include_everything)
+        collapsed.core, counts, collapsed.summaries = self.core.collapse(clusters, self.include_everything)
+        collapsed.graph_attrs = collections.OrderedDict(self.graph_attrs)
+        collapsed.node_attrs.update(self.node_attrs)
+        collapsed.inherited_styles = self.propagated_styles()
+        collapsed.edge_attrs = self.edge_attrs
+
+        for cluster, members in collapsed.summaries.items():
+            label = "{} ({} nodes)".format(self.core.data(cluster).get("label") or cluster, members)
+            collapsed.node_attrs[cluster] = parse_attrs('label={}; shape=folder; style=filled; fillcolor="#eeeeee"'.format(json.dumps(label)))
+        for (start, end), n in counts.items():
+            if n > 1:
+                collapsed.core.add_edge(start, end, {"label": "{} edges".format(n)})
+        return collapsed
+
+    def _memoized(self, name, compute):
+        # The core counts every change, so its version tells whether what we have is stale
+        version = self.core.version
+        if self._memo.get(name, (None,))[0] != version:
+            self._memo[name] = (version, compute())
+        return self._memo[name][1]
+
+    def forget_memoized(self, keep=()):
+        """ Forgets what's been worked out about the graph, but for the names in keep, to save memory on
+        graphs that are kept around. """
+        for name in [name for name in self._memo if name not in keep]:
+            del self._memo[name]
+
+    def reachability(self):
+        """ Returns a ReachabilityIndex for the graph as it is now. Subgraph relations don't make nodes reachable. """
+        return self._memoized('reachability', lambda: ReachabilityIndex(self.core))
+
+    def redundant_edges(self):
+        """ Returns the edges a transitive reduction of the graph leaves out. Subgraph relations are left alone. """
+        return self._memoized('redundant_edges', lambda: self.reachability().redundant_edges())
+
+    def get_graph_data(self, compact_closure=False, include_closure=True, apply_transitive_reduction=False):
+        redundant_edges = self.redundant_edges() if apply_transitive_reduction else ()
+        edges = dict((node_id, {}) for node_id in self.core)
+        for a, b, data in self.core.edges(data=True):
+            if (a, b) not in redundant_edges:
+                edges[a][b] = dict(data)
+        for parent, child in self.core.forest_edges():
+            edges[parent].setdefault(child, {})['is_subgraph_relation'] = True
+
+        graph_data = {
+            "edges": edges
         }
+        if self.summaries:
+            graph_data["collapsed"] = self.summaries
+        if include_closure and compact_closure:
+            graph_data.update(self.reachability().compact_closure())
+        elif include_closure:
+            graph_data["transitive_closure"] = self.reachability().closure()
+        return graph_data
 
 
 class GraphTests(unittest.TestCase):
@@ -429,6 +1458,288 @@ c --> d
                 graph.get_graph_data()['edges'], expectedEdgeData
             )
 
+        self.assertEquals(
+            Graph.from_lines(lines, jobs=2).get_graph_data()['edges'], expectedEdgeData
+        )
+
+    def test_parallel_parsing_keeps_statement_order(self):
+        lines = ["..attr: n{0}: color=red".format(i % 7) if i % 3 else "n{0} --> n{1}".format(i, i + 1) for i in range(100)]
+        self.assertEqual(
+            list(parse_lines_in_parallel(lines, jobs=3, chunk_size=8)),
+            list(iter_statements(lines))
+        )
+
+    def test_parallel_parsing_raises_what_reading_lines_does(self):
+        def lines():
+            yield b"\xff --> b".decode("utf-8")
+
+        self.assertRaises(UnicodeDecodeError, list, parse_lines_in_parallel(lines(), jobs=2))
+
+    def test_parallel_parsing_can_stop_early(self):
+        statements = parse_lines_in_parallel(("a --> b" for _ in range(1000)), jobs=2, chunk_size=10)
+        self.assertEqual(next(statements), {"start": "a", "end": "b"})
+        statements.close()
+
+    def test_reachability_index_agrees_with_networkx(self):
+        import networkx
+        rng = random.Random(7)
+        g = networkx.DiGraph()
+        g.add_nodes_from(range(30))
+        g.add_edges_from((rng.randrange(30), rng.randrange(30)) for _ in range(45))
+        index = ReachabilityIndex(g)
+
+        self.assertEqual(index.closure(), dict(networkx.transitive_closure(g).succ._atlas))
+        for node in g:
+            self.assertEqual(index.ancestors(node), networkx.ancestors(g, node))
+            self.assertEqual(index.descendants(node), networkx.descendants(g, node))
+            self.assertEqual(set(index.propagate({node: 1}, "ancestors")), networkx.ancestors(g, node))
+            self.assertEqual(set(index.propagate({node: 1}, "descendants")), networkx.descendants(g, node))
+            for other in g:
+                if node != other:
+                    self.assertEqual(index.reaches(node, other), other in networkx.descendants(g, node))
+            for other, nodes in zip(g, index.shortest_paths_of((node, other) for other in g)):
+                expected = set()
+                if networkx.has_path(g, node, other):
+                    expected = set(n for path in networkx.all_shortest_paths(g, node, other) for n in path)
+                self.assertEqual(nodes, expected)
+
+    def test_empty_graph(self):
+        # An empty graph has no components, not one without members like networkx's condensation makes up
+        import networkx
+        index = ReachabilityIndex(networkx.DiGraph())
+        self.assertEqual((index.members, index.closure(), index.redundant_edges()), ([], {}, set()))
+
+        graph = Graph.from_string("Nothing to see here")
+        self.assertEqual(graph.get_graph_data(), {"edges": {}, "transitive_closure": {}})
+        self.assertEqual(graph.render_dot().split(), ["digraph", "G", "{", "}"])
+
+    def test_transitive_reduction(self):
+        import networkx
+        rng = random.Random(3)
+        g = networkx.DiGraph()
+        g.add_edges_from((a, b) for a, b in ((rng.randrange(25), rng.randrange(25)) for _ in range(60)) if a < b)
+        self.assertEqual(
+            set(g.edges()) - ReachabilityIndex(g).redundant_edges(),
+            set(networkx.transitive_reduction(g).edges())
+        )
+
+        graph = Graph.from_string("""
+a --> b, b --> c, a --> c
+c --> d, d --> c, c --> e, d --> e, a --> e
+..subgraph: scope: a, c
+""")
+        # Edges within the c/d cycle stay, and so do both edges out of it
+        self.assertEqual(graph.redundant_edges(), set([("a", "c"), ("a", "e")]))
+        self.assertNotIn('"a" -> "c"', graph.render_dot(apply_transitive_reduction=True))
+        self.assertIn('"a" -> "c"', graph.render_dot())
+        edges = graph.get_graph_data(apply_transitive_reduction=True)["edges"]
+        self.assertEqual(sorted(edges["a"]), ["b"])
+        self.assertEqual(sorted(edges["scope"]), ["a", "c"])
+
+        # Reductions can be forgotten, and are worked out again when they're needed
+        graph.forget_memoized(keep=("reachability",))
+        self.assertEqual(list(graph._memo), ["reachability"])
+        self.assertEqual(graph.redundant_edges(), set([("a", "c"), ("a", "e")]))
+
+    def test_literal_prefix(self):
+        self.assertEqual(_literal_prefix("svc[.]api[.].*"), "svc.api.")
+        self.assertEqual(_literal_prefix("db\\.[0-9]+"), "db.")
+        self.assertEqual(_literal_prefix("ab?c"), "a")
+        self.assertEqual(_literal_prefix("a|b"), "")
+        self.assertEqual(_literal_prefix("^abc"), "")
+
+    def test_subgraph_patterns(self):
+        graph = Graph.from_string("""
+svc.api --> svc.db, svc.db --> db1, web --> svc.api
+..subgraph: services: svc.*
+..subgraph: databases: /db[0-9]/
+""")
+        graph.resolve_subgraph_patterns()
+        self.assertEqual(sorted(graph.g.successors("services")), ["svc.*", "svc.api", "svc.db"])
+        self.assertEqual(sorted(graph.g.successors("databases")), ["/db[0-9]/", "db1"])
+
+        # Nodes that turn up later are matched too
+        graph.include_statements(search_for_statements("svc.cache --> db2"))
+        graph.resolve_subgraph_patterns()
+        self.assertEqual(sorted(graph.g.successors("services")), ["svc.*", "svc.api", "svc.cache", "svc.db"])
+        self.assertEqual(sorted(graph.g.successors("databases")), ["/db[0-9]/", "db1", "db2"])
+
+    def test_compact_closure(self):
+        graph = Graph.from_string("a --> b, b --> c, c --> b")
+        compact = graph.get_graph_data(compact_closure=True)
+        closure = graph.get_graph_data()["transitive_closure"]
+
+        nodes = compact["nodes"]
+        self.assertEqual(
+            dict((nodes[i], dict((nodes[j], {}) for j in descendants)) for i, descendants in enumerate(compact["transitive_closure"])),
+            closure
+        )
+
+    def test_compact_core(self):
+        graph = Graph.from_string("""
+a --> b
+b --> c
+..subgraph: outer: inner, a
+..subgraph: inner: b
+""")
+        self.assertTrue(graph.core.is_forest())
+        self.assertEqual(list(graph.core.edges()), [("a", "b"), ("b", "c")])
+        self.assertEqual(graph.core.children_of("outer"), ["inner", "a"])
+        self.assertEqual(graph.core.parent_of("b"), "inner")
+        # Containment doesn't make subgraphs reach their members
+        self.assertEqual(graph.reachability().descendants("outer"), set())
+        self.assertTrue(graph.g.succ["outer"]["a"]["is_subgraph_relation"])
+
+        graph.include_statement(search_for_statements("..subgraph: other: b")[0])
+        self.assertFalse(graph.core.is_forest())
+
+        cyclic = Graph.from_string("..subgraph: x: y\n..subgraph: y: x")
+        self.assertFalse(cyclic.core.is_forest())
+
+    def test_focus(self):
+        graph = Graph.from_string("""
+a --> b
+b --> c
+c --> d
+x --> c
+..subgraph: outer: inner
+..subgraph: inner: b, z
+""")
+        self.assertEqual(graph.neighbourhood("b", 1), set(["a", "b", "c"]))
+        self.assertEqual(graph.neighbourhood("b", 1, "down"), set(["b", "c"]))
+        self.assertEqual(graph.neighbourhood("c", direction="up"), set(["a", "b", "c", "x"]))
+        self.assertEqual(graph.between("a", "d"), set(["a", "b", "c", "d"]))
+        self.assertEqual(graph.between("d", "a"), set(["a", "d"]))
+
+        focused = focused_graph(graph, focus="b", depth=1, direction="down")
+        self.assertEqual(list(focused.core.edges()), [("b", "c")])
+        # The subgraphs around b come along, but not the rest of their members
+        self.assertEqual(focused.core.parent_of("inner"), "outer")
+        self.assertEqual(focused.core.children_of("inner"), ["b"])
+        self.assertNotIn('"a"', focused.render_dot())
+
+        self.assertIs(focused_graph(graph), graph)
+        self.assertRaises(LookupError, focused_graph, graph, between="a,nope")
+        self.assertRaises(ValueError, focused_graph, graph, focus="a", direction="sideways")
+
+    def test_positions(self):
+        positioned = '\n'.join([
+            'digraph G {',
+            '\tgraph [bb="0,0,126,108"];',
+            '\tnode [label="\\N", shape=plaintext];',
+            '\tsubgraph cluster_s {',
+            '\t\tgraph [bb="8,8,118,100", id=s];',
+            '\t\t"s.a"\t[id="s.a", label=a, pos="63,82", width=0.75];',
+            '\t}',
+            '\tb\t[height=0.5,',
+            '\t\tlabel="b [x]",',
+            '\t\tpos="27.5,18"];',
+            '\t"s.a" -> b\t[id="s.a/b", pos="e,36.2,36.1 53.8,63.7 49.6,55.5"];',
+            '}',
+        ])
+        self.assertEqual(parse_positions(positioned), {"s.a": "63,82", "b": "27.5,18"})
+
+        memory = LayoutMemory()
+        memory.remember("page", Graph.from_string("s.a --> b"), {"s.a": "63,82", "b": "27.5,18"})
+        graph = Graph.from_string("s.a --> b\nb --> c")
+        # b got an edge, so it may move. c is new, so it goes wherever.
+        self.assertEqual(memory.recall("page", graph), {"s.a": "63,82!", "b": "27.5,18"})
+        self.assertEqual(memory.recall("other", graph), {})
+        self.assertIn('"s.a" [pos="63,82!"];', graph.render_dot(positions=memory.recall("page", graph)))
+
+        # Only the most recently used layouts are kept
+        memory.max_entries = 2
+        memory.remember("other", graph, {})
+        memory.recall("page", graph)
+        memory.remember("third", graph, {})
+        self.assertEqual(list(memory.layouts), ["page", "third"])
+
+    def test_style_directives(self):
+        graph = Graph.from_string("""
+a --> b
+b --> c
+c --> d
+x --> c
+..attr: b: color=blue
+..descendants: a: highlight
+..ancestors: c: style=dashed; penwidth=2
+..allPaths: x --> d: color=red
+..descendants: nope: color=green
+""")
+        styles = graph.node_styles()
+        # The last directive wins, then the node's own attrs
+        self.assertEqual(format_attrs(styles["a"]), 'style=dashed; penwidth=2')
+        self.assertEqual(format_attrs(styles["b"]), 'style=dashed; fillcolor="pink"; penwidth=2; color=blue')
+        self.assertEqual(format_attrs(styles["c"]), 'style="filled"; fillcolor="pink"; color=red')
+        self.assertEqual(format_attrs(styles["x"]), 'style=dashed; penwidth=2; color=red')
+
+        dot = graph.render_dot()
+        self.assertIn('"d" [id="d"; label="d"; style="filled"; fillcolor="pink"; color=red];', dot)
+        # Rendering doesn't change the graph
+        self.assertEqual(graph.render_dot(), dot)
+
+        # Focused graphs keep the styles of the whole graph
+        self.assertIn('"b" [id="b"; style=dashed; fillcolor="pink"; penwidth=2; color=blue];', graph.focus(["b"]).render_dot())
+
+        with self.assertRaises(ValueError):
+            Graph.from_string("..allPaths: a: highlight")
+
+    def test_collapse(self):
+        graph = Graph.from_string("""
+a --> x1
+a --> x2
+x1 --> y1
+x2 --> y1
+y1 --> b
+y2 --> y1
+..subgraph: x, The Xs: x1, x2, y
+..subgraph: y: y1, y2, y3
+""")
+        self.assertIs(collapsed_graph(graph), graph)
+
+        collapsed = collapsed_graph(graph, collapse_depth=0)
+        self.assertEqual(collapsed.summaries, {"x": 4})
+        self.assertEqual(sorted(collapsed.core.edges(data=True)), [("a", "x", {"label": "2 edges"}), ("x", "b", {})])
+        dot = collapsed.render_dot()
+        self.assertIn('"x" [id="x"; label="The Xs (4 nodes)"; shape=folder; style=filled; fillcolor="#eeeeee"];', dot)
+        self.assertNotIn("cluster_x", dot)
+        self.assertEqual(collapsed.get_graph_data(include_closure=False)["collapsed"], {"x": 4})
+        # y3 has no edges, so it isn't counted, and isn't there when x is expanded
+        self.assertEqual(sorted(collapsed_graph(graph, expand="x").core), ["x", "x1", "x2", "y", "y1", "y2"])
+
+        # The inner subgraph is collapsed within the outer one
+        collapsed = collapsed_graph(graph, collapse_depth=1)
+        self.assertEqual(collapsed.summaries, {"y": 2})
+        self.assertEqual(collapsed.core.parent_of("y"), "x")
+        self.assertIn(("x1", "y"), list(collapsed.core.edges()))
+        self.assertIn("subgraph cluster_x", collapsed.render_dot())
+
+        # There are 6 nodes with nothing collapsed, 5 with y collapsed, and 3 with x collapsed
+        self.assertIs(collapsed_graph(graph, node_budget=6), graph)
+        self.assertEqual(collapsed_graph(graph, node_budget=5).summaries, {"y": 2})
+        self.assertEqual(collapsed_graph(graph, node_budget=1).summaries, {"x": 4})
+
+        # Expanding x shows only what's in it, with levels counted from within it
+        expanded = collapsed_graph(graph, collapse_depth=0, expand="x")
+        self.assertEqual(sorted(expanded.core), ["x", "x1", "x2", "y"])
+        self.assertEqual(expanded.summaries, {"y": 2})
+        self.assertRaises(LookupError, collapsed_graph, graph, expand="nope")
+        self.assertRaises(ValueError, collapsed_graph, graph, expand="a")
+
+    def test_dot_blocks(self):
+        graph = Graph.from_lines(synthetic_corpus(200))
+        blocks = list(encoded_blocks(graph.iter_dot(), size=1000))
+        self.assertEqual(b"".join(blocks), graph.render_dot().encode("utf8"))
+        self.assertTrue(all(len(block) >= 1000 for block in blocks[:-1]))
+
+    def test_attrs(self):
+        attrs = parse_attrs(' tooltip="a \\" b"color=red; label=<<b>c; d</b>>, !nope !target')
+        self.assertEqual(list(attrs.items()), [
+            ('tooltip', '"a \\" b"'), ('color', '"#ef5098"'), ('label', '<<b>c; d</b>>'), ('!nope', None), ('shape', 'doubleoctagon')
+        ])
+        self.assertEqual(format_attrs(attrs), 'tooltip="a \\" b"; color="#ef5098"; label=<<b>c; d</b>>; !nope; shape=doubleoctagon')
+        self.assertEqual(format_attrs(parse_attrs(" highlight ")), 'style="filled"; fillcolor="pink"')
+
     def stripIndentation(self, input):
         """ Returns input with whitespace stripped and empty lines removed"""
         return '\n'.join(l.strip() for l in input.split('\n') if l)
@@ -458,8 +1769,8 @@ digraph G {
     }
 
 "a" -> "b" [id="a/b"]
-"c" -> "d" [id="c/d"]
 "b" -> "c" [id="b/c"; color=red; tooltip="Comment"; label="Label"]
+"c" -> "d" [id="c/d"]
 
 "c" [id="c"; label="c"];
 }""")
@@ -467,84 +1778,2256 @@ digraph G {
         self.assertEquals(graph.render_dot(), expectedDot)
 
 
-def make_graph_from_dot(dot, layout_engine="dot", format='svg', apply_transitive_reduction=False):
+class RenderCache(object):
+    """ Remembers rendered graphs, keyed by a hash of everything that goes into rendering them.
+
+    Recently used renders are kept in memory. If a directory is given, renders are also written
+    there, and the least recently used files are removed once they take up more than max_disk_bytes.
+    Only files the cache wrote are counted and removed, so the directory can be shared.
+    """
+
+    # What the files of renders are named with, after their keys
+    suffix = '.render'
+
+    def __init__(self, max_entries=32, directory=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = collections.Counter()
+        self.misses = 0
+        self.use_directory(directory, max_disk_bytes)
+
+    def use_directory(self, directory, max_disk_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            part = part if isinstance(part, bytes) else '{}'.format(part).encode('utf8')
+            # Length-prefix the parts so they cannot run into each other
+            digest.update('{}:'.format(len(part)).encode('utf8'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                value = self.memory.pop(key)
+                self.memory[key] = value
+                self.hits['memory'] += 1
+                return value
+
+        path = self.directory and self._path(key)
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    value = f.read()
+                # Bump the modification time, since that's what eviction goes by
+                os.utime(path, None)
+            except (IOError, OSError):
+                # Another process evicted it since we looked
+                value = None
+            if value is not None:
+                with self.lock:
+                    self.hits['disk'] += 1
+                self._remember(key, value)
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.directory:
+            path = self._path(key)
+            # Write to a temporary file first, so readers never see a partial render. Each write gets
+            # its own, since other threads and processes may be writing the same key.
+            fd, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(value)
+                os.rename(temporary_path, path)
+            except Exception:
+                os.remove(temporary_path)
+                raise
+            self._evict_from_disk()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.memory.pop(key, None)
+            self.memory[key] = value
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def _evict_from_disk(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # Some other process evicted it already
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        return dict(
+            memory_hits=self.hits['memory'], disk_hits=self.hits['disk'], misses=self.misses,
+            memory_entries=len(self.memory)
+        )
+
+
+render_cache = RenderCache()
+
+
+class StageTimings(object):
+    """ How long each stage of making a graph took, and counts and sizes of what went through them. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0) + time.time() - started
+
+    def count(self, name, n):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def server_timing(self):
+        """ Returns the stages as the value of a Server-Timing header. """
+        return ", ".join("{};dur={:.1f}".format(name, seconds * 1000) for name, seconds in self.seconds.items())
+
+    def report(self):
+        lines = ["{:<20}{:>12.3f}s".format(name, seconds) for name, seconds in self.seconds.items()]
+        lines += ["{:<20}{:>12}".format(name, n) for name, n in self.counts.items()]
+        return "\n".join(lines)
+
+
+def counted(items, timings, name):
+    """ Yields items, counting them in timings under name once they're exhausted. """
+    if timings is None:
+        for item in items:
+            yield item
+        return
+
+    n = 0
+    try:
+        for item in items:
+            n += 1
+            yield item
+    finally:
+        timings.count(name, n)
+
+
+class StageMetrics(object):
+    """ Cumulative histograms of how long each stage takes per profile, and the latest counts and sizes,
+    in the Prometheus text format. """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Observations per bucket, then the count and sum, by (profile, stage)
+        self.histograms = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+
+    def observe(self, profile, timings):
+        with self.lock:
+            for stage, seconds in timings.seconds.items():
+                histogram = self.histograms.setdefault((profile, stage), [0] * (len(self.buckets) + 2))
+                for i, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        histogram[i] += 1
+                histogram[-2] += 1
+                histogram[-1] += seconds
+            for name, n in timings.counts.items():
+                self.counts[(profile, name)] = n
+
+    def render(self, cache=None, layouts=None):
+        lines = ['# TYPE graphspec_stage_seconds histogram']
+        with self.lock:
+            for (profile, stage), histogram in self.histograms.items():
+                labels = 'profile="{}",stage="{}"'.format(profile, stage)
+                for bound, n in zip(self.buckets, histogram):
+                    lines.append('graphspec_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, n))
+                lines.append('graphspec_stage_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, histogram[-2]))
+                lines.append('graphspec_stage_seconds_sum{{{}}} {}'.format(labels, histogram[-1]))
+                lines.append('graphspec_stage_seconds_count{{{}}} {}'.format(labels, histogram[-2]))
+
+            lines.append('# TYPE graphspec_last_count gauge')
+            for (profile, name), n in self.counts.items():
+                lines.append('graphspec_last_count{{profile="{}",what="{}"}} {}'.format(profile, name, n))
+
+        if cache:
+            lines.append('# TYPE graphspec_render_cache gauge')
+            for name, n in sorted(cache.stats().items()):
+                lines.append('graphspec_render_cache{{what="{}"}} {}'.format(name, n))
+        if layouts:
+            lines.append('# TYPE graphspec_layouts gauge')
+            for name, n in sorted(layouts.stats().items()):
+                lines.append('graphspec_layouts{{what="{}"}} {}'.format(name, n))
+        return "\n".join(lines) + "\n"
+
+
+stage_metrics = StageMetrics()
+
+
+def graphviz_args(format):
+    return ['-Gfontname=Open Sans', '-Efontname=Open Sans Light', '-Nfontname=Open Sans Light'] + '-Nshape=plaintext -Gpenwidth=1 -Epenwidth=1 -Gcolor=#bbbbbb -Gratio=compress -T{}'.format(format).split()
+
+
+def encoded_blocks(chunks, size=64 * 1024):
+    """ Yields the text of chunks as UTF-8, in blocks of at least size bytes but the last. """
+    block, length = [], 0
+    for chunk in chunks:
+        block.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(block).encode("utf8")
+            block, length = [], 0
+    if block:
+        yield ''.join(block).encode("utf8")
+
+
+class LayoutTimeout(Exception):
+    pass
+
+
+class LayoutService(object):
+    """ Runs Graphviz, at most workers layouts at once, by default one per core. Others wait their turn.
+
+    A layout that isn't done timeout seconds after it was asked for, waiting included, raises LayoutTimeout,
+    and its Graphviz is killed. Each layout is a Graphviz process of its own, as Graphviz's library can't
+    lay out graphs in parallel within a process, and the command line is all that's sure to be installed.
+    """
+
+    def __init__(self, workers=None, timeout=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Notified whenever a layout's done, so the next one can go
+        self.done = threading.Condition(self.lock)
+        self.running = 0
+        self.waiting = 0
+        self.counts = collections.Counter()
+
+    @contextlib.contextmanager
+    def _slot(self, deadline):
+        with self.lock:
+            self.waiting += 1
+            try:
+                while self.running >= self.workers:
+                    if deadline is not None and deadline <= time.time():
+                        self.counts["timeouts"] += 1
+                        raise LayoutTimeout("timed out waiting for a layout worker")
+                    self.done.wait(None if deadline is None else deadline - time.time())
+            finally:
+                self.waiting -= 1
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.done.notify()
+
+    def run(self, dot, program, args, timeout=None):
+        """ Returns what program outputs for dot, which can be bytes or an iterable of blocks of bytes.
+        timeout overrides the service's. """
+        import sh
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            # sh takes no timeout as none at all
+            return None if deadline is None else max(deadline - time.time(), 0.001)
+
+        # What went wrong making blocks of dot
+        failed = []
+
+        def blocks(dot):
+            # sh reads these in a thread of its own, which would only log an error and leave the program
+            # waiting for the rest. Ending the input instead ends the program, as what it got so far
+            # isn't a whole graph, and the error's raised once it's done.
+            try:
+                for block in dot:
+                    yield block
+            except Exception as e:
+                failed.append(e)
+
+        with self._slot(deadline):
+            try:
+                rendered = getattr(sh, program)(*args, _in=dot if isinstance(dot, bytes) else blocks(dot), _timeout=remaining()).stdout
+            except sh.TimeoutException:
+                with self.lock:
+                    self.counts["timeouts"] += 1
+                raise LayoutTimeout("layout timed out after {} seconds".format(timeout))
+            except (sh.ErrorReturnCode, sh.SignalException):
+                # Not getting part of a graph laid out is no surprise
+                if not failed:
+                    raise
+            if failed:
+                raise failed[0]
+        with self.lock:
+            self.counts["completed"] += 1
+        return rendered
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, running=self.running, waiting=self.waiting, workers=self.workers)
+
+
+layout_service = LayoutService()
+
+
+def make_graph_from_dot(dot, layout_engine="dot", format='svg', cache=render_cache, layout_args=()):
+    """ Lays out and renders dot, which is DOT as bytes, or an iterable of blocks of it. Blocks are streamed
+    to Graphviz as they're made. Renders of bytes are cached in cache, but renders of blocks can't be looked
+    up before they're all made, so they aren't. """
     assert layout_engine in ("dot", "neato", "fdp"), "Unknown layout engine"
-    dot_args = ['-Gfontname=Open Sans', '-Efontname=Open Sans Light', '-Nfontname=Open Sans Light'] + '-Nshape=plaintext -Gpenwidth=1 -Epenwidth=1 -Gcolor=#bbbbbb -Gratio=compress -T{}'.format(format).split()
+    dot_args = graphviz_args(format) + list(layout_args)
+    cache = cache if isinstance(dot, bytes) else None
+
+    if cache:
+        key = cache.key(dot, layout_engine, format, *dot_args)
+        rendered = cache.get(key)
+        if rendered is not None:
+            logger.debug("Found render in cache: {}".format(key))
+            return rendered
 
     logger.debug("Running [{} {}]".format(layout_engine, ' '.join(dot_args)))
+    rendered = layout_service.run(dot, layout_engine, dot_args)
+    if cache:
+        cache.put(key, rendered)
+    return rendered
+
+
+# Only these engines take positions to start from
+INCREMENTAL_LAYOUT_ENGINES = ("neato", "fdp")
+
+_dot_node_statement = re.compile(r'^\s*("(?:[^"\\]|\\.)*"|[^\s\[\]";{}]+)\s+\[((?:[^\]"]|"(?:[^"\\]|\\.)*")*)\]', re.MULTILINE)
+_dot_pos = re.compile(r'(?:^|[\s,])pos="(-?[0-9.e+-]+),(-?[0-9.e+-]+)!?"')
+
+
+def parse_positions(dot):
+    """ Returns the position of every node in DOT that's been laid out, in points, by node id. """
+    positions = {}
+    for node_id, attrs in _dot_node_statement.findall(dot):
+        if node_id in ("graph", "node", "edge"):
+            continue
+        pos = _dot_pos.search(attrs)
+        if pos:
+            if node_id.startswith('"'):
+                node_id = node_id[1:-1].replace('\\"', '"')
+            positions[node_id] = "{},{}".format(*pos.groups())
+    return positions
+
+
+def make_incremental_graph_from_dot(dot, layout_engine, format='svg', cache=render_cache):
+    """ Lays out dot with neato or fdp, and renders it. Returns the rendering and the position of every node.
+
+    The layout is made as DOT with positions, which neato -n2 then renders as is. Positions come back in
+    inches, as pos attributes going into a layout take them.
+    """
+    assert layout_engine in INCREMENTAL_LAYOUT_ENGINES, "Layout engine can't start from positions"
+    positioned = make_graph_from_dot(dot, layout_engine, "dot", cache=cache)
+    rendered = make_graph_from_dot(positioned, "neato", format, cache=cache, layout_args=["-n2"])
+    positions = dict(
+        (node_id, ",".join("{:g}".format(float(points) / 72) for points in pos.split(",")))
+        for node_id, pos in parse_positions(positioned.decode("utf8")).items()
+    )
+    return rendered, positions
+
+
+class LayoutMemory(object):
+    """ Where the nodes of earlier layouts went, so that later layouts of the same graph can keep them there.
+
+    Nodes whose edges haven't changed are pinned where they were, and nodes whose edges have changed start
+    from where they were. Only new nodes are placed from scratch. That keeps the picture stable, and gives
+    the layout engine less to do. Only the max_entries most recently used layouts are kept.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Positions and edge signatures of nodes, by what was laid out, least recently used first
+        self.layouts = collections.OrderedDict()
+
+    def recall(self, lineage, graph):
+        """ Returns the pos attributes for the next layout of graph, by node id. """
+        with self.lock:
+            layout = self.layouts.pop(lineage, None)
+            if layout:
+                self.layouts[lineage] = layout
+        if not layout:
+            return {}
+
+        signatures = graph.edge_signatures()
+        return dict(
+            (node_id, pos + "!" if layout["signatures"].get(node_id) == signatures.get(node_id) else pos)
+            for node_id, pos in layout["positions"].items()
+            if node_id in signatures
+        )
 
-    if apply_transitive_reduction:
-        dot = sh.tred(_in=dot).stdout
+    def remember(self, lineage, graph, positions):
+        with self.lock:
+            self._store(lineage, {"positions": positions, "signatures": graph.edge_signatures()})
+
+    def _store(self, lineage, layout):
+        self.layouts.pop(lineage, None)
+        self.layouts[lineage] = layout
+        while len(self.layouts) > self.max_entries:
+            self.layouts.popitem(last=False)
+
+    def load(self, path):
+        if os.path.exists(path):
+            with open(path) as f:
+                layouts = json.load(f, object_pairs_hook=collections.OrderedDict)
+            with self.lock:
+                for lineage, layout in layouts.items():
+                    self._store(lineage, layout)
+
+    def save(self, path):
+        with self.lock:
+            data = json.dumps(self.layouts)
+        with open(path, "w") as f:
+            f.write(data)
 
-    return getattr(sh, layout_engine)(*dot_args, _in=dot).stdout
+
+layout_memory = LayoutMemory()
 
 
 # We'll prepare a very simple web interface, where a profiles file
 # can define combinations of annotation sources
 
 base_path = os.path.dirname(os.path.realpath(__file__)) + '/'
-app = flask.Flask(__name__, static_url_path='/static/', static_folder=base_path, template_folder=base_path + "templates/")
 profiles = {}
-
-def get_lines_from_profile(profile):
+# Sources of paths profiles, by their paths, so they can be refreshed incrementally
+path_sources = {}
+path_sources_lock = threading.Lock()
+# How many profile sources to fetch at once, and how long to wait for each by default.
+# Profiles can set their own "timeout".
+source_workers = 4
+source_timeout = 60
+_source_pool = None
+
+# The patterns ripgrep looks for in a profile's paths. With --only-matching, this just gets
+# us the excerpts the patterns actually cover, not anything prior.
+RIPGREP_PATTERNS = [
+    '([^ ]+) --> ([^ ,]+) *:: *.*', # An edge with a comment
+    '\\.\\.(subgraph|attr|allPaths|ancestors|descendants):.*', # A statement
+    '([^ ]+) --> ([^ ,]+)', # A simple edge
+]
+
+def get_lines_from_profile(profile, timeout=None, cwd=None):
+    """ Yields the lines of a profile's source as they're produced. """
     if profile.get('shell'):
         # It's some shell command that gets us data
-        return os.popen(profile['shell']).read().decode('utf-8').split('\n')
+        return stream_command(profile['shell'], timeout, cwd)
 
     elif profile.get('paths'):
         # A list of paths to provide to ripgrep
-        cmd = " ".join([
-            "rg --no-filename",
-            "--only-matching", # This just gets us the excerpts the following patterns actually cover, not anything prior
-            "--regexp '([^ ]+) --> ([^ ,]+) *:: *.*'", # An edge with a comment
-            "--regexp '\.\.(subgraph|attr|allPaths|ancestors|descendants):.*'", # A statement
-            "--regexp '([^ ]+) --> ([^ ,]+)' " # A simple edge
-        ] + profile['paths']) # And lastly the paths
-        return os.popen(cmd).read().decode('utf-8').split('\n')
+        cmd = " ".join(
+            ["rg --no-filename --only-matching"] +
+            ["--regexp '{}'".format(pattern) for pattern in RIPGREP_PATTERNS] +
+            profile['paths'] # And lastly the paths
+        )
+        return stream_command(cmd, timeout, cwd)
+
+
+SourceFile = collections.namedtuple('SourceFile', 'mtime size digest statements')
+
+
+def expand_path(path):
+    """ Expands ~ and environment variables in path, like the shell would. """
+    return os.path.expandvars(os.path.expanduser(path))
+
+
+def expand_paths(paths):
+    """ Expands ~, environment variables and globs in paths, like the shell would. Globs that match
+    nothing are left as they are. """
+    expanded = []
+    for path in paths:
+        path = expand_path(path)
+        expanded.extend(sorted(glob.glob(path)) or [path])
+    return expanded
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PathsSource(object):
+    """ The statements ripgrep finds in a list of paths, remembered per file.
+
+    Each refresh lists the files again, but only files whose size, modification time and content
+    changed are searched and parsed again.
+    """
+
+    # Changed files are handed to ripgrep this many at a time, to stay clear of argument length limits
+    files_per_search = 500
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.files = {}
+        self.lock = threading.Lock()
+        self.deadline = None
+
+    def _ripgrep(self, *args):
+        timeout = None
+        if self.deadline is not None:
+            timeout = self.deadline - time.time()
+            if timeout <= 0:
+                raise SourceTimeout()
+        # rg exits with 1 if nothing matched, which is fine, and with 2 if some paths couldn't be searched,
+        # such as missing ones, which still leaves what was found in the rest
+        import sh
+        result = sh.rg(*args, _ok_code=[0, 1, 2], _tty_out=False, _timeout=timeout)
+        if result.exit_code == 2:
+            logger.warning("ripgrep could not search all of [{}]: {}".format(", ".join(self.paths), result.stderr.decode('utf-8').strip()))
+        return result.stdout.decode('utf-8')
+
+    def _search(self, paths):
+        """ Returns the matching excerpts in paths, by path. """
+        lines_by_path = collections.defaultdict(list)
+        pattern_args = ['--regexp={}'.format(pattern) for pattern in RIPGREP_PATTERNS]
+        for i in range(0, len(paths), self.files_per_search):
+            output = self._ripgrep('--with-filename', '--null', '--no-line-number', '--only-matching', *(pattern_args + ['--'] + paths[i:i + self.files_per_search]))
+            for line in output.split('\n'):
+                path, _, excerpt = line.partition('\0')
+                if excerpt:
+                    lines_by_path[path].append(excerpt)
+        return lines_by_path
+
+    def refresh(self):
+        """ Updates the statements of files that changed, and returns the paths of those files. """
+        listed = [path for path in self._ripgrep('--files', '--', *expand_paths(self.paths)).split('\n') if path]
+        changed = []
+        for path in listed:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Gone since it was listed
+                continue
+
+            known = self.files.get(path)
+            if known and (known.mtime, known.size) == (stat.st_mtime, stat.st_size):
+                continue
+
+            digest = _file_digest(path)
+            if known and known.digest == digest:
+                # Touched, but not changed
+                self.files[path] = known._replace(mtime=stat.st_mtime, size=stat.st_size)
+                continue
+
+            changed.append((path, stat, digest))
+
+        for path in set(self.files) - set(listed):
+            del self.files[path]
+
+        lines_by_path = self._search([path for path, _, _ in changed]) if changed else {}
+        for path, stat, digest in changed:
+            statements = list(iter_statements(lines_by_path.get(path, [])))
+            self.files[path] = SourceFile(stat.st_mtime, stat.st_size, digest, statements)
+
+        return [path for path, _, _ in changed]
+
+    def statements(self, timeout=None):
+        """ Refreshes and returns all statements. The whole refresh may take up to timeout seconds. """
+        with self.lock:
+            self.deadline = None if timeout is None else time.time() + timeout
+            try:
+                self.refresh()
+            finally:
+                self.deadline = None
+            return [statement for path in sorted(self.files) for statement in self.files[path].statements]
+
+
+_page_templates = None
+
+
+def _tojson(value):
+    # Like Flask's tojson, safe to put in a <script>
+    return json.dumps(value, sort_keys=True).replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026").replace("'", "\\u0027")
+
+
+def page_templates():
+    """ Returns the Jinja environment for pages. It's made without Flask, so pages can be made without serving them. """
+    global _page_templates
+    with _lazy_lock:
+        if _page_templates is None:
+            import jinja2
+            _page_templates = jinja2.Environment(loader=jinja2.FileSystemLoader(base_path + "templates/"), autoescape=True)
+            _page_templates.filters["tojson"] = _tojson
+    return _page_templates
+
+
+_static_files = {}
+
+
+def static_file_contents(name):
+    """ Returns a file next to graphspec.py, read the first time it's asked for. """
+    if name not in _static_files:
+        with open(base_path + name) as f:
+            _static_files[name] = f.read().decode("utf8")
+    return _static_files[name]
 
 
 def make_html(svg, graph_data, **kw):
     # We inline this so the output is a standalone file
-    js = open(base_path + 'graphspec.js').read().decode("utf8")
-    css = open(base_path + 'graphspec.css').read().decode("utf8")
+    js = static_file_contents('graphspec.js')
+    css = static_file_contents('graphspec.css')
+
+    return page_templates().get_template("graph.html").render(svg=svg, js=js, css=css, graph_data=graph_data, sorted=sorted, **kw).encode("utf8")
+
+
+# The routes of the web interface, added to the Flask app once it's made
+_routes = []
+_app = None
+
+
+def route(rule, **options):
+    """ Like Flask's app.route, for an app that's only made when serving. """
+    def add(view):
+        _routes.append((rule, options, view))
+        return view
+    return add
 
-    return app.jinja_env.get_template("graph.html").render(svg=svg, js=js, css=css, graph_data=graph_data, sorted=sorted, **kw).encode("utf8")
 
+def get_app():
+    """ Returns the Flask app, making it the first time. """
+    global _app
+    with _lazy_lock:
+        if _app is None:
+            import flask
+            _app = flask.Flask(__name__, static_url_path='/static/', static_folder=base_path, template_folder=base_path + "templates/")
+            for rule, options, view in _routes:
+                _app.add_url_rule(rule, view.__name__, view, **options)
+    return _app
 
-@app.route('/', methods=['GET'])
+
+@route('/', methods=['GET'])
 def root():
+    import flask
     return flask.render_template("profile-list.html", profiles=profiles)
 
 
-@app.route('/static/<path:path>')
+@route('/static/<path:path>')
 def static_file(path):
+    import flask
     return flask.send_static_file(path)
 
 
-@app.route('/<profile_names>', methods=['GET'])
-def profile(profile_names):
-    lines = []
-    profile_names = profile_names.split(",")
-    for profile_name in profile_names:
-        profile = profiles.get(profile_name)
-        if not profile:
-            return 'no such profile: "{}"'.format(profile_name), 404
-        lines.extend(get_lines_from_profile(profile))
-
-    include_everything = flask.request.args.get("include_everything", False)
-    graph = Graph.from_lines(lines, include_everything=include_everything)
-    graph_data = graph.get_graph_data()
-    apply_transitive_reduction = flask.request.args.get("apply_transitive_reduction", False)
-    layout_engine = flask.request.args.get("layout_engine", "dot")
-
-    svg = make_graph_from_dot(graph.render_dot().encode("utf8"), layout_engine, "svg", apply_transitive_reduction).decode("utf8")
+def get_statements_from_profile(profile, timeout=None, timings=None, cwd=None):
+    """ Returns the statements of a profile. Its shell command runs in cwd, and its paths are relative to
+    cwd, if given. """
+    if profile.get('paths'):
+        key = tuple(os.path.join(cwd, path) if cwd else path for path in profile['paths'])
+        with path_sources_lock:
+            if key not in path_sources:
+                path_sources[key] = PathsSource(list(key))
+        return path_sources[key].statements(timeout)
+
+    return iter_statements(counted(get_lines_from_profile(profile, timeout, cwd), timings, "lines"))
+
+
+SourceReport = collections.namedtuple('SourceReport', 'profile_name seconds error')
+
+
+def fetch_profiles(profile_names, timings=None):
+    """ Gets the statements of several profiles concurrently.
+
+    Returns the statements of each profile, in order, and a SourceReport per profile. A profile whose
+    source fails or times out is reported with its error, and contributes no statements.
+    """
+    global _source_pool
+    with _lazy_lock:
+        if _source_pool is None:
+            _source_pool = ThreadPool(source_workers)
+
+    import sh
+
+    def fetch(profile_name):
+        profile = profiles[profile_name]
+        timeout = profile.get('timeout', source_timeout)
+        started = time.time()
+        try:
+            statements = list(counted(get_statements_from_profile(profile, timeout, timings), timings, "statements"))
+            error = None
+        except (SourceTimeout, sh.TimeoutException):
+            statements, error = [], "timed out after {} seconds".format(timeout)
+        except Exception as e:
+            logger.exception("Could not get statements for [{}]".format(profile_name))
+            statements, error = [], "{}: {}".format(type(e).__name__, e)
+        return statements, SourceReport(profile_name, time.time() - started, error)
+
+    results = _source_pool.map(fetch, profile_names)
+    return [statements for statements, _ in results], [report for _, report in results]
+
+
+def graph_for_profiles(profile_names, include_everything=False, timings=None):
+    """ Builds the graph of some profiles. Returns the graph and a SourceReport per profile. """
+    timings = timings or StageTimings()
+    graph = Graph(include_everything=include_everything)
+    with timings.stage("source"):
+        statements_by_profile, reports = fetch_profiles(profile_names, timings)
+    with timings.stage("graph"):
+        for statements in statements_by_profile:
+            graph.include_statements(statements)
+
+    return graph, reports
+
+
+FOCUS_DIRECTIONS = ("down", "up", "both")
+
+
+def focused_graph(graph, focus=None, depth=None, direction="both", between=None):
+    """ Returns the part of graph around the focus node, or between two comma-separated nodes.
+    Returns the whole graph if neither is asked for. """
+    if between:
+        nodes = between.split(",")
+        if len(nodes) != 2:
+            raise ValueError('between takes two nodes, not "{}"'.format(between))
+    elif focus:
+        nodes = [focus]
+        if direction not in FOCUS_DIRECTIONS:
+            raise ValueError('direction must be one of {}, not "{}"'.format(", ".join(FOCUS_DIRECTIONS), direction))
+    else:
+        return graph
+
+    for node in nodes:
+        if node not in graph.core:
+            raise LookupError('no such node: "{}"'.format(node))
+
+    if between:
+        return graph.focus(graph.between(*nodes))
+    return graph.focus(graph.neighbourhood(focus, depth, direction))
+
+
+def collapsed_graph(graph, collapse_depth=None, node_budget=None, expand=None):
+    """ Returns graph with each subgraph collapse_depth levels down made a single node. With a node_budget
+    instead, subgraphs are collapsed as far down as leaves at most that many nodes, or all the way up if
+    that's too many. With expand, only what's in that subgraph is shown, and levels count from within it.
+    Returns graph as it is if it's not asked to collapse or expand.
+
+    Raises LookupError for an expand that isn't there, and ValueError for one that isn't a subgraph.
+    """
+    offset = 0
+    if expand:
+        if expand not in graph.core:
+            raise LookupError('no such subgraph: "{}"'.format(expand))
+        if not graph.core.children_of(expand):
+            raise ValueError('"{}" is not a subgraph'.format(expand))
+        offset = graph.core.depths()[expand] + 1
+        # What's in it that's rendered, so it shows as many nodes as it stood for
+        graph = graph.focus([node_id for node_id in graph.core.below(expand) if graph.should_include_node(node_id)])
+    if collapse_depth is None and node_budget is None:
+        return graph
+
+    # Subgraphs by level, and how many other nodes are rendered at each level
+    clusters = collections.defaultdict(list)
+    leaves = collections.Counter()
+    for node_id, depth in graph.core.depths().items():
+        if depth < offset:
+            continue
+        if graph.core.children_of(node_id):
+            clusters[depth - offset].append(node_id)
+        elif not graph.core.data(node_id).get('subgraph') and graph.should_include_node(node_id):
+            leaves[depth - offset] += 1
+
+    if collapse_depth is None:
+        if sum(leaves.values()) <= node_budget:
+            return graph
+        # Collapsing at a level leaves the nodes above it, and a node for each subgraph at it
+        collapse_depth = 0
+        for depth in sorted(clusters, reverse=True):
+            if sum(n for level, n in leaves.items() if level <= depth) + len(clusters[depth]) <= node_budget:
+                collapse_depth = depth
+                break
+    return graph.collapse(clusters.get(collapse_depth, []))
+
+
+def query_string(args):
+    """ Returns args as a query string, in a stable order. """
+    from werkzeug.urls import url_encode
+    return url_encode(args, sort=True)
+
+
+def build_profile_page(profile_names, args):
+    """ Builds the page of some profiles, as asked for by the request args in args. Returns a Snapshot.
+
+    Raises LookupError for nodes that aren't there, and ValueError for args that make no sense.
+    """
+    timings = StageTimings()
+    include_everything = args.get("include_everything", False)
+    graph, source_reports = graph_for_profiles(profile_names, include_everything, timings)
+    for report in source_reports:
+        logger.info("Got [{}] in {:.2f}s{}".format(report.profile_name, report.seconds, report.error and ": " + report.error or ""))
+
+    with timings.stage("focus"):
+        graph = focused_graph(
+            graph,
+            focus=args.get("focus"),
+            depth=int(args["depth"]) if args.get("depth") else None,
+            direction=args.get("direction", "both"),
+            between=args.get("between"),
+        )
+
+    def level_of_detail(name):
+        # The request's, or else the profiles'
+        values = [args.get(name)] + [profiles[profile_name].get(name) for profile_name in profile_names]
+        return next((int(value) for value in values if value is not None and value != ""), None)
+
+    with timings.stage("collapse"):
+        graph = collapsed_graph(graph, level_of_detail("collapse_depth"), level_of_detail("node_budget"), args.get("expand"))
+    timings.count("nodes", len(graph.core))
+    timings.count("edges", graph.core.number_of_edges())
+
+    apply_transitive_reduction = args.get("apply_transitive_reduction", False)
+    if apply_transitive_reduction:
+        with timings.stage("transitive_reduction"):
+            graph.redundant_edges()
+    with timings.stage("graph_data"):
+        if args.get("inline_closure", False):
+            graph_data = graph.get_graph_data(compact_closure=True, apply_transitive_reduction=apply_transitive_reduction)
+        else:
+            # The page asks for ancestors and descendants when they're needed, of the graph it shows
+            graph_data = graph.get_graph_data(include_closure=False, apply_transitive_reduction=apply_transitive_reduction)
+            graph_data["closure_url"] = "/" + ",".join(profile_names)
+            graph_data["closure_query"] = query_string(args)
+    if graph.summaries:
+        # Collapsed subgraphs are expanded by asking for them
+        graph_data["expand_url"] = "/{}/expand?{}".format(",".join(profile_names), query_string(dict((k, v) for k, v in args.items() if k != "expand")))
+    if any(profile_name in file_watchers for profile_name in profile_names):
+        # The page listens for new versions when files change
+        graph_data["events_url"] = "/{}/events?{}".format(",".join(profile_names), query_string(args))
+    layout_engine = args.get("layout_engine", "dot")
+    # Keep nodes where they were the last time this page was laid out
+    incremental = layout_engine in INCREMENTAL_LAYOUT_ENGINES and (
+        args.get("incremental_layout") or any(profiles[profile_name].get("incremental_layout") for profile_name in profile_names)
+    )
+    lineage = "/{}?{}".format(",".join(profile_names), query_string(args))
+
+    with timings.stage("dot"):
+        positions = layout_memory.recall(lineage, graph) if incremental else None
+        dot = graph.render_dot(apply_transitive_reduction, positions).encode("utf8")
+    timings.count("dot_bytes", len(dot))
+    with timings.stage("layout"):
+        if incremental:
+            svg, positions = make_incremental_graph_from_dot(dot, layout_engine, "svg")
+            layout_memory.remember(lineage, graph, positions)
+        else:
+            svg = make_graph_from_dot(dot, layout_engine, "svg")
+        svg = svg.decode("utf8")
+    timings.count("svg_bytes", len(svg))
 
     exclude = lambda a, v: [i for i in a if i != v]
 
-    return make_html(svg, graph_data, active_profiles=profile_names, profiles=profiles, exclude=exclude)
+    with timings.stage("html"):
+        html = make_html(svg, graph_data, active_profiles=profile_names, profiles=profiles, exclude=exclude, source_reports=source_reports,
+                         query_string=query_string(args))
+    timings.count("html_bytes", len(html))
+    with timings.stage("compress"):
+        encoded = compress_page(html)
+    timings.count("gzip_bytes", len(encoded["gzip"]))
+
+    # The page's timings change with every build, so the ETag goes by what they're timings of. Pages that
+    # differ only in their timings are the same page, but not the same bytes, so the ETag is a weak one.
+    etag = RenderCache.key(
+        svg, json.dumps(graph_data, sort_keys=True), ",".join(profile_names), query_string(args),
+        json.dumps([(report.profile_name, report.error) for report in source_reports])
+    )
+
+    stage_metrics.observe(",".join(profile_names), timings)
+    # Snapshots keep the graph only to answer closure queries
+    graph.forget_memoized(keep=("reachability",))
+    return Snapshot(graph, html, svg, graph_data, timings.server_timing(), time.time(), etag, encoded)
+
+
+# graph is the graph the page shows, which closure queries are answered from, etag is a hash of what's on the
+# page but for its timings, for a weak ETag, and encoded has html compressed, by Content-Encoding
+Snapshot = collections.namedtuple('Snapshot', 'graph html svg graph_data server_timing built_at etag encoded')
+
+# Content-Encodings pages are sent with, most preferred first
+PAGE_ENCODINGS = ("br", "gzip")
+
+
+def compress_page(html):
+    """ Returns html compressed with every encoding in PAGE_ENCODINGS that's available, by encoding.
+    Brotli needs the brotli module, gzip is always there. """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    encoded = {"gzip": compressor.compress(html) + compressor.flush()}
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        encoded["br"] = brotli.compress(html, mode=brotli.MODE_TEXT)
+    return encoded
+
+
+class Snapshots(object):
+    """ The latest build of every page that's been asked for, so requests don't wait for sources and layouts.
+
+    Like HTTP's stale-while-revalidate: a snapshot is served as is for max_age seconds. After that it's
+    still served right away, but rebuilt in the background, until it's stale_while_revalidate seconds
+    past max_age. Requests for anything older wait for the rebuild. Snapshots can also be rebuilt every
+    refresh seconds, as long as someone's listening for updates to them, or they've been asked for in
+    the last idle_after seconds.
+
+    Only the max_entries most recently used snapshots are kept.
+    """
+
+    def __init__(self, build, policy, max_entries=64, idle_after=600):
+        # build(key) makes a Snapshot, and policy(key) returns max_age, stale_while_revalidate and refresh
+        self.build = build
+        self.policy = policy
+        self.max_entries = max_entries
+        self.idle_after = idle_after
+        self.lock = threading.Lock()
+        # Notified whenever a snapshot's been built
+        self.built = threading.Condition(self.lock)
+        # Least recently used first
+        self.snapshots = collections.OrderedDict()
+        # When each snapshot was last asked for, and how many are listening for updates to it
+        self.requested = {}
+        self.listeners = collections.Counter()
+        # Events set once builds in progress are done, by key
+        self.building = {}
+
+    def clear(self):
+        with self.lock:
+            self.snapshots.clear()
+            self.requested.clear()
+
+    def _wanted(self, key, now):
+        return self.listeners[key] > 0 or now - self.requested.get(key, 0) <= self.idle_after
+
+    def _store(self, key, snapshot):
+        self.snapshots.pop(key, None)
+        self.snapshots[key] = snapshot
+        # Snapshots someone's listening to stay
+        excess = max(0, len(self.snapshots) - self.max_entries)
+        for evicted in [k for k in self.snapshots if not self.listeners[k]][:excess]:
+            del self.snapshots[evicted]
+            self.requested.pop(evicted, None)
+
+    def get(self, key):
+        with self.lock:
+            snapshot = self.snapshots.pop(key, None)
+            if snapshot is not None:
+                self.snapshots[key] = snapshot
+            self.requested[key] = time.time()
+        if snapshot is None:
+            return self.rebuild(key)
+
+        max_age, stale_while_revalidate, _ = self.policy(key)
+        age = time.time() - snapshot.built_at
+        if age <= max_age:
+            return snapshot
+        if stale_while_revalidate is None or age <= max_age + stale_while_revalidate:
+            self.rebuild_in_background(key)
+            return snapshot
+        return self.rebuild(key)
+
+    def current(self, key):
+        """ Returns the snapshot of key as it is, however old, and only builds it if there's none. For
+        queries about a page that's already been served, which should be answered from what's on it. """
+        with self.lock:
+            snapshot = self.snapshots.pop(key, None)
+            if snapshot is not None:
+                self.snapshots[key] = snapshot
+            self.requested[key] = time.time()
+        return snapshot or self.rebuild(key)
+
+    def rebuild(self, key):
+        """ Builds the snapshot of key and returns it. If it's already being built, waits for that instead. """
+        with self.lock:
+            done = self.building.get(key)
+            if done is None:
+                done = self.building[key] = threading.Event()
+                building = True
+            else:
+                building = False
+
+        if not building:
+            done.wait()
+            with self.lock:
+                snapshot = self.snapshots.get(key)
+            # The other build failed, so we'll have our own go
+            return snapshot or self.rebuild(key)
+
+        try:
+            snapshot = self.build(key)
+            with self.lock:
+                self._store(key, snapshot)
+                self.built.notify_all()
+            return snapshot
+        finally:
+            with self.lock:
+                del self.building[key]
+            done.set()
+
+    def rebuild_in_background(self, key):
+        with self.lock:
+            if key in self.building:
+                return
+
+        def rebuild():
+            try:
+                self.rebuild(key)
+            except Exception:
+                # We'll keep serving what we had
+                logger.exception("Could not rebuild [{}]".format(key))
+
+        thread = threading.Thread(target=rebuild, name="rebuild {}".format(key))
+        thread.daemon = True
+        thread.start()
+
+    def rebuild_matching(self, predicate):
+        """ Starts rebuilding every snapshot whose key predicate is true for, if it's wanted. Those that
+        aren't are dropped, to be built again when they're next asked for. """
+        now = time.time()
+        keys = []
+        with self.lock:
+            for key in [key for key in self.snapshots if predicate(key)]:
+                if self._wanted(key, now):
+                    keys.append(key)
+                else:
+                    del self.snapshots[key]
+                    self.requested.pop(key, None)
+        for key in keys:
+            self.rebuild_in_background(key)
+
+    def updates(self, key, timeout=15):
+        """ Yields the snapshot of key whenever it's been rebuilt into something new. Yields None when
+        there's been nothing new for timeout seconds. """
+        with self.lock:
+            last = self.snapshots.get(key)
+            self.listeners[key] += 1
+        deadline = time.time() + timeout
+        try:
+            while True:
+                with self.built:
+                    # Woken by builds of other snapshots too
+                    self.built.wait(max(deadline - time.time(), 0))
+                    snapshot = self.snapshots.get(key)
+                if snapshot is not None and (last is None or snapshot.etag != last.etag):
+                    last = snapshot
+                    deadline = time.time() + timeout
+                    yield snapshot
+                    continue
+                if snapshot is not None:
+                    # Rebuilt into the same thing
+                    last = snapshot
+                if time.time() >= deadline:
+                    deadline = time.time() + timeout
+                    yield None
+        finally:
+            with self.lock:
+                self.listeners[key] -= 1
+                if not self.listeners[key]:
+                    del self.listeners[key]
+
+    def refresh_due(self):
+        """ Starts rebuilding every snapshot that's due a refresh, and has been asked for lately. """
+        now = time.time()
+        with self.lock:
+            snapshots = [(key, snapshot) for key, snapshot in self.snapshots.items() if self._wanted(key, now)]
+        for key, snapshot in snapshots:
+            refresh = self.policy(key)[2]
+            if refresh is not None and now - snapshot.built_at >= refresh:
+                self.rebuild_in_background(key)
+
+    def refresh_periodically(self, interval=1):
+        def run():
+            while True:
+                time.sleep(interval)
+                self.refresh_due()
+
+        thread = threading.Thread(target=run, name="refresh snapshots")
+        thread.daemon = True
+        thread.start()
+
+
+def _strictest(values, default=None):
+    values = [value for value in (default if value is None else value for value in values) if value is not None]
+    return min(values) if values else default
+
+
+def snapshot_policy(key):
+    """ Returns max_age, stale_while_revalidate and refresh for a snapshot. With several profiles, the strictest
+    of each goes. Profiles set them in seconds. Both ages default to 0, so pages are only served stale by
+    profiles that ask for it. """
+    profile_names, _ = key
+    policies = [profiles[profile_name] for profile_name in profile_names.split(",") if profile_name in profiles]
+    return (
+        _strictest([policy.get("max_age") for policy in policies], 0),
+        _strictest([policy.get("stale_while_revalidate") for policy in policies], 0),
+        _strictest([policy.get("refresh") for policy in policies]),
+    )
+
+
+snapshots = Snapshots(lambda key: build_profile_page(key[0].split(","), dict(key[1])), snapshot_policy)
+
+
+def page_key(profile_names, args):
+    """ Returns what the snapshot of a page is known by. """
+    return profile_names, tuple(sorted(args.to_dict().items()))
+
+
+# inotify events for anything being written, moved, made or removed
+IN_CHANGES = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+
+
+def _inotify_init():
+    """ Returns libc and an inotify file descriptor, or None where there's no inotify. """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return None
+    return (libc, fd) if fd >= 0 else None
+
+
+class FileWatcher(object):
+    """ Watches files, and calls on_change once they've changed and then been left alone for debounce seconds.
+
+    Files are given as globs, or directories to watch everything in. What changed is found by comparing
+    modification times and sizes, and inotify tells us when to look where it's available. Elsewhere we
+    look every poll_interval seconds.
+    """
+
+    def __init__(self, patterns, on_change, debounce=0.3, poll_interval=2, use_inotify=True):
+        self.patterns = patterns
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.inotify = _inotify_init() if use_inotify else None
+        self.watched_directories = set()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _watch(self, directory):
+        if self.inotify and directory not in self.watched_directories:
+            libc, fd = self.inotify
+            if isinstance(directory, type("")):
+                directory = directory.encode(sys.getfilesystemencoding())
+            if libc.inotify_add_watch(fd, directory, IN_CHANGES) >= 0:
+                self.watched_directories.add(directory)
+
+    def files(self):
+        """ Returns the modification time and size of every watched file, by path. """
+        stats = {}
+
+        def add(path):
+            try:
+                stat = os.stat(path)
+                stats[path] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                # Gone since we listed it
+                pass
+
+        for pattern in self.patterns:
+            # ~ and variables are expanded like PathsSource does, and globs are matched anew each time
+            pattern = expand_path(pattern)
+            # New files may turn up where the pattern points
+            if os.path.isdir(os.path.dirname(pattern) or "."):
+                self._watch(os.path.dirname(pattern) or ".")
+            for path in glob.glob(pattern):
+                if not os.path.isdir(path):
+                    add(path)
+                    continue
+                for directory, directories, filenames in os.walk(path):
+                    # Like ripgrep, leave out hidden directories such as .git
+                    directories[:] = [name for name in directories if not name.startswith(".")]
+                    self._watch(directory)
+                    for filename in filenames:
+                        add(os.path.join(directory, filename))
+        return stats
+
+    def _wait(self, timeout):
+        """ Waits for timeout seconds, or less if inotify says something happened or we're stopped. """
+        if not self.inotify:
+            self.stopped.wait(timeout)
+            return
+        fd = self.inotify[1]
+        deadline = time.time() + timeout
+        while not self.stopped.is_set() and time.time() < deadline:
+            if select.select([fd], [], [], min(1, deadline - time.time()))[0]:
+                # We only need to know something happened, not what
+                os.read(fd, 65536)
+                return
+
+    def run(self):
+        last = self.files()
+        while not self.stopped.is_set():
+            # Even with inotify, look every now and then, in case e.g. the watches ran out
+            self._wait(self.poll_interval * 15 if self.inotify else self.poll_interval)
+            current = self.files()
+            if current == last or self.stopped.is_set():
+                continue
+
+            # Let things settle, as editors and version control often write a few files in a row
+            while True:
+                time.sleep(self.debounce)
+                settled = self.files()
+                if settled == current:
+                    break
+                current = settled
+            last = current
+
+            try:
+                self.on_change()
+            except Exception:
+                logger.exception("Could not handle changes to [{}]".format(", ".join(self.patterns)))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="watch {}".format(", ".join(self.patterns)))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.inotify:
+            os.close(self.inotify[1])
+
+
+# The FileWatcher of every profile whose files are watched, by profile name
+file_watchers = {}
+
+
+def watch_profiles():
+    """ Starts watching the files of profiles with paths, or watch globs. Pages of profiles whose files
+    change are rebuilt, once, and pushed to their open pages. """
+    def rebuild(profile_name):
+        return lambda: snapshots.rebuild_matching(lambda key: profile_name in key[0].split(","))
+
+    for profile_name, profile in profiles.items():
+        patterns = profile.get('watch') or profile.get('paths')
+        if patterns:
+            file_watchers[profile_name] = FileWatcher(patterns, rebuild(profile_name)).start()
+
+
+def page_snapshot(lookup, profile_names, args):
+    """ Returns the snapshot of the page of some profiles, as asked for by args, from lookup, which is
+    snapshots.get or snapshots.current. Returns None and a response instead, if there's no such page. """
+    for profile_name in profile_names.split(","):
+        if profile_name not in profiles:
+            return None, ('no such profile: "{}"'.format(profile_name), 404)
+
+    try:
+        return lookup(page_key(profile_names, args)), None
+    except LookupError as e:
+        return None, (e.args[0], 404)
+    except ValueError as e:
+        return None, (e.args[0], 400)
+    except LayoutTimeout as e:
+        return None, (e.args[0], 503)
+
+
+@route('/<profile_names>', methods=['GET'])
+def profile(profile_names):
+    import flask
+    snapshot, error = page_snapshot(snapshots.get, profile_names, flask.request.args)
+    if error:
+        return error
+
+    encoding = flask.request.accept_encodings.best_match([name for name in PAGE_ENCODINGS if name in snapshot.encoded])
+    # Each encoding of the page is a different representation, so each has its own ETag
+    etag = snapshot.etag + "-" + encoding if encoding else snapshot.etag
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.make_response("", 304)
+    else:
+        response = flask.make_response(snapshot.encoded[encoding] if encoding else snapshot.html)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Server-Timing"] = snapshot.server_timing
+    response.set_etag(etag, weak=True)
+    # Browsers keep the page, but check it's still the latest first
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Age"] = str(int(time.time() - snapshot.built_at))
+    return response
+
+
+@route('/<profile_names>/events', methods=['GET'])
+def events(profile_names):
+    """ Streams the new SVG and graph data of a page whenever it's rebuilt, as server-sent events. """
+    import flask
+    key = page_key(profile_names, flask.request.args)
+
+    def stream():
+        for snapshot in snapshots.updates(key):
+            if snapshot is None:
+                # Keeps proxies from closing the connection
+                yield ": nothing new\n\n"
+            else:
+                yield "event: update\ndata: {}\n\n".format(json.dumps({"svg": snapshot.svg, "graph": snapshot.graph_data}))
+
+    return flask.Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@route('/<profile_names>/expand', methods=['GET'])
+def expand(profile_names):
+    """ Returns the SVG and graph data of the page of one collapsed subgraph, with what's in it laid out. """
+    import flask
+    args = flask.request.args.copy()
+    node = args.pop("node", None)
+    if not node:
+        return "expand needs a node", 400
+    args["expand"] = node
+    snapshot, error = page_snapshot(snapshots.current, profile_names, args)
+    if error:
+        return error
+    return flask.jsonify(svg=snapshot.svg, graph=snapshot.graph_data)
+
+
+@route('/metrics', methods=['GET'])
+def metrics():
+    import flask
+    return flask.Response(stage_metrics.render(render_cache, layout_service), mimetype="text/plain; version=0.0.4")
+
+
+@route('/<profile_names>/<any(ancestors, descendants):direction>/<node>', methods=['GET'])
+def closure(profile_names, direction, node):
+    """ Returns the ancestors or descendants of a node in the graph of the page the request args are of,
+    which is focused and collapsed like the page. """
+    import flask
+    snapshot, error = page_snapshot(snapshots.current, profile_names, flask.request.args)
+    if error:
+        return error
+
+    graph = snapshot.graph
+    if node not in graph.core:
+        return 'no such node: "{}"'.format(node), 404
+
+    reachability = graph.reachability()
+    nodes = reachability.ancestors(node) if direction == "ancestors" else reachability.descendants(node)
+    return flask.jsonify(node=node, direction=direction, nodes=sorted(nodes))
+
+
+# Benchmarks run on made-up corpora, so they can be compared between machines and over time
+
+NOISE_LINES = [
+    "This paragraph explains the design, but has no edges in it.",
+    "    if (a->b && c > d) { return x--; }",
+    "<em>Some</em> markup, and an arrow -> pointing nowhere",
+    "# A heading, followed by prose .. and an ellipsis",
+    "    result = [value for value in values if value > threshold]",
+    "see the attr documentation for details",
+]
+
+
+def synthetic_corpus(edges, seed=0, comment_density=0.2, subgraph_depth=3, fanout=4, patterns=True, attr_density=0.05,
+                     noise_density=0.5):
+    """ Yields the lines of a made-up graphspec corpus with about edges edges. The same arguments always
+    give the same lines.
+
+    Nodes are named by the nested subgraphs they're in, e.g. g1.g3.n42. Every subgraph but the innermost
+    lists its children; the innermost take their nodes by a glob pattern, or by listing them without patterns.
+    """
+    # Only use random(), as the other methods differ between Python versions
+    rng = random.Random(seed)
+    nodes = max(edges // 2, 2)
+
+    def scope_of(i):
+        return ".".join("g{}".format((i * 7919 // fanout ** level) % fanout) for level in range(subgraph_depth))
+
+    def node_id(i):
+        return "{}.n{}".format(scope_of(i), i) if subgraph_depth else "n{}".format(i)
+
+    def noise():
+        while rng.random() < noise_density:
+            yield NOISE_LINES[int(rng.random() * len(NOISE_LINES))]
+
+    for _ in range(edges):
+        # Mostly edges on to nearby nodes, like the layers of a real system, and the odd short cycle
+        start = int(rng.random() * (nodes - 1))
+        if rng.random() < 0.02:
+            end = max(start - int(rng.random() * 10), 0)
+        else:
+            end = start + 1 + int(rng.random() ** 4 * (nodes - start - 1))
+        line = "{} --> {}".format(node_id(start), node_id(end))
+        if rng.random() < comment_density:
+            line += " :: because of reason {}".format(int(rng.random() * 1000))
+        if rng.random() < attr_density:
+            yield "..attr: {}, Label: color=red; style=dashed :: An important one".format(line.split(" :: ")[0])
+        else:
+            yield line
+        for line in noise():
+            yield line
+
+    for i in range(nodes):
+        if rng.random() < attr_density:
+            yield "..attr: {}: shape=box; color=blue".format(node_id(i))
+
+    scopes = collections.OrderedDict()
+    for i in range(nodes):
+        if subgraph_depth:
+            scopes.setdefault(scope_of(i), []).append(node_id(i))
+    parents = collections.OrderedDict()
+    for scope, members in scopes.items():
+        yield "..subgraph: {0}, Scope {0}: {1}".format(scope, scope + ".*" if patterns else ", ".join(members))
+        parts = scope.split(".")
+        for depth in range(1, len(parts)):
+            children = parents.setdefault(".".join(parts[:depth]), [])
+            if ".".join(parts[:depth + 1]) not in children:
+                children.append(".".join(parts[:depth + 1]))
+    for parent, children in parents.items():
+        yield "..subgraph: {}: {}".format(parent, ", ".join(children))
+
+
+BENCHMARK_SCALES = (1000, 10000, 100000)
+
+
+def _best_of(repeat, setup, run):
+    """ Returns the fastest of repeat runs, in seconds. setup() makes what run() gets, and isn't timed. """
+    best = None
+    for _ in range(repeat):
+        argument = setup()
+        started = timeit.default_timer()
+        run(argument)
+        seconds = timeit.default_timer() - started
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def run_benchmarks(scales=BENCHMARK_SCALES, repeat=3, slow_max_edges=10000):
+    """ Times each stage of making a graph from synthetic corpora of several sizes.
+
+    Returns the results as a dict that can be dumped as JSON, and compared to a baseline with
+    compare_benchmarks(). Transitive closures grow with the square of the nodes, and layouts worse,
+    so they're only timed up to slow_max_edges. Layouts also need Graphviz installed.
+    """
+    results = {"python": platform.python_version(), "repeat": repeat, "scales": {}}
+    for edges in scales:
+        lines = list(synthetic_corpus(edges))
+        graph = Graph.from_lines(lines)
+        dot = graph.render_dot().encode("utf8")
+        seconds = collections.OrderedDict()
+
+        def parse_all(lines):
+            for line in lines:
+                search_for_statements(line)
+
+        seconds["search_for_statements"] = _best_of(repeat, lambda: lines, parse_all)
+        seconds["from_lines"] = _best_of(repeat, lambda: lines, Graph.from_lines)
+        seconds["render_dot"] = _best_of(repeat, lambda: Graph.from_lines(lines), lambda graph: graph.render_dot())
+        seconds["get_graph_data"] = _best_of(repeat, lambda: Graph.from_lines(lines), lambda graph: graph.get_graph_data(include_closure=False))
+        if edges <= slow_max_edges:
+            seconds["compact_closure"] = _best_of(repeat, lambda: Graph.from_lines(lines), lambda graph: graph.reachability().compact_closure())
+        if edges <= slow_max_edges and installed("dot"):
+            seconds["layout"] = _best_of(repeat, lambda: dot, lambda dot: make_graph_from_dot(dot, cache=None))
+
+        results["scales"][str(edges)] = {
+            "lines": len(lines), "nodes": len(graph.core), "edges": graph.core.number_of_edges(), "dot_bytes": len(dot),
+            "seconds": seconds
+        }
+        logger.info("Benchmarked {} edges: {}".format(edges, ", ".join("{} {:.3f}s".format(*item) for item in seconds.items())))
+
+    results["startup"] = {"seconds": startup_seconds(repeat)}
+    return results
+
+
+# Small graphs are mostly startup: the CLI shouldn't import what it doesn't use
+STARTUP_FLAGS = ("--dot", "--json")
+
+
+def startup_seconds(repeat=3):
+    """ Times making a tiny graph with each of STARTUP_FLAGS, in a new Python each time. """
+    def run(flag):
+        process = subprocess.Popen([sys.executable, os.path.realpath(__file__), flag], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.communicate(b"a --> b\n")
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, flag)
+
+    return collections.OrderedDict((flag.lstrip("-"), _best_of(repeat, lambda: flag, run)) for flag in STARTUP_FLAGS)
+
+
+def compare_benchmarks(results, baseline, tolerance=0.2):
+    """ Returns (scale, stage, baseline seconds, seconds) for every stage that's more than tolerance slower than in baseline.
+    Startup times have the scale "startup". Stages missing from either are left out. """
+    regressions = []
+    compared = sorted(results["scales"].items(), key=lambda item: int(item[0]))
+    if "startup" in results and "startup" in baseline:
+        compared.append(("startup", results["startup"]))
+    for scale, result in compared:
+        baseline_seconds = (baseline["startup"] if scale == "startup" else baseline["scales"].get(scale, {})).get("seconds", {})
+        for stage, seconds in result["seconds"].items():
+            if stage in baseline_seconds and seconds > baseline_seconds[stage] * (1 + tolerance):
+                regressions.append((scale, stage, baseline_seconds[stage], seconds))
+    return regressions
+
+
+# Batches make many outputs in one go, e.g. for building docs
+
+BATCH_FORMATS = ("dot", "json", "svg", "png", "pdf", "html")
+
+
+def _layout_job(job):
+    dot, layout_engine, format = job
+    try:
+        return make_graph_from_dot(dot, layout_engine, format), None
+    except Exception as e:
+        # Exceptions from sh don't pickle, so only what went wrong comes back
+        return None, "{}: {}".format(type(e).__name__, e)
+
+
+def run_batch(manifest, base_path=".", timings=None):
+    """ Writes all the outputs a batch manifest asks for. Returns the paths written, and (path, error) for
+    every output that couldn't be made.
+
+    The manifest lists graphs, each with a name and either a profile or an input file, and the formats
+    and layout engines to output them in. Every profile and input is read and parsed once, and every
+    graph is turned into DOT once. Layouts run in a pool of processes, jobs of them, or one per core by
+    default. A graph whose profile or input can't be read fails all its outputs, but not the rest of the
+    batch. For example:
+
+        output_dir: build/graphs
+        profiles: profiles.yaml
+        formats: [svg, html]
+        graphs:
+          - name: services
+            profile: services
+            engines: [dot, neato]
+          - name: readme
+            input: README.md
+            formats: [png, json]
+
+    Outputs are named after the graph and format, e.g. readme.png. With several engines, the engine goes
+    in the name too, e.g. services.neato.svg. Paths are relative to base_path, and profiles' shell
+    commands run there.
+    """
+    timings = timings or StageTimings()
+    output_dir = os.path.join(base_path, manifest.get("output_dir", "."))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if manifest.get("profiles"):
+        import yaml
+        profiles.update(yaml.safe_load(open(os.path.join(base_path, manifest["profiles"]))))
+
+    written, failures = [], []
+
+    def write(path, content):
+        with open(path, "wb") as f:
+            f.write(content)
+        written.append(path)
+
+    # The graph of every profile and input, or what went wrong reading it, by what it was read from
+    graphs_read = {}
+
+    def read_graph(source, include_everything, timeout):
+        if (source, include_everything) not in graphs_read:
+            with timings.stage("parse"):
+                graph = Graph(include_everything=include_everything)
+                try:
+                    if source[0] == "profile":
+                        graph.include_statements(get_statements_from_profile(profiles[source[1]], timeout, timings, cwd=base_path))
+                    else:
+                        with open(os.path.join(base_path, source[1]), "rb") as f:
+                            graph.include_statements(iter_statements(counted(iter_lines(f), timings, "lines")))
+                    error = None
+                except Exception as e:
+                    logger.exception("Could not read [{}]".format(source[1]))
+                    graph, error = None, "{}: {}".format(type(e).__name__, e)
+            graphs_read[source, include_everything] = graph, error
+        return graphs_read[source, include_everything]
+
+    # What's laid out, and what's made of each layout: (path, graph data for HTML, or None)
+    layouts = collections.OrderedDict()
+    for entry in manifest["graphs"]:
+        setting = lambda key, default=None: entry.get(key, manifest.get(key, default))
+        name = entry["name"]
+        formats = setting("formats", ["svg"])
+        engines = setting("engines", ["dot"])
+        for format in formats:
+            if format not in BATCH_FORMATS:
+                raise ValueError('Unknown format "{}" for [{}], not one of {}'.format(format, name, ", ".join(BATCH_FORMATS)))
+
+        path = lambda extension, engine=None: os.path.join(output_dir, ".".join(
+            [name] + ([engine] if engine and len(engines) > 1 else []) + [extension]
+        ))
+        source = ("profile", entry["profile"]) if "profile" in entry else ("input", entry["input"])
+        graph, error = read_graph(source, setting("include_everything", False), setting("timeout", source_timeout))
+        if error:
+            failures.extend(
+                (path(format, engine), error)
+                for format in formats
+                for engine in (engines if format in ("svg", "png", "pdf", "html") else [None])
+            )
+            continue
+        timings.count("nodes", len(graph.core))
+        timings.count("edges", graph.core.number_of_edges())
+
+        transitive_reduction = setting("transitive_reduction", False)
+        with timings.stage("dot"):
+            dot = graph.render_dot(transitive_reduction).encode("utf8")
+        compact_closure = setting("compact_closure", False)
+        with timings.stage("graph_data"):
+            graph_data = html_graph_data = None
+            if "json" in formats:
+                graph_data = graph.get_graph_data(compact_closure=compact_closure, apply_transitive_reduction=transitive_reduction)
+            if "html" in formats:
+                # Pages always inline the closure compactly, whatever the JSON's is like
+                html_graph_data = graph_data if graph_data is not None and compact_closure else graph.get_graph_data(
+                    compact_closure=True, apply_transitive_reduction=transitive_reduction
+                )
+
+        if "dot" in formats:
+            write(path("dot"), dot)
+        if "json" in formats:
+            write(path("json"), json.dumps(graph_data, indent=4).encode("utf8"))
+        for engine in engines:
+            for format in formats:
+                if format in ("svg", "png", "pdf"):
+                    layouts.setdefault((dot, engine, format), []).append((path(format, engine), None))
+                elif format == "html":
+                    layouts.setdefault((dot, engine, "svg"), []).append((path(format, engine), html_graph_data))
+
+    rendered = []
+    if layouts:
+        with timings.stage("layout"):
+            pool = multiprocessing.Pool(min(manifest.get("jobs", 0) or multiprocessing.cpu_count(), len(layouts)))
+            try:
+                rendered = pool.map(_layout_job, list(layouts))
+            finally:
+                pool.terminate()
+                pool.join()
+
+    with timings.stage("write"):
+        for (rendered_graph, error), outputs in zip(rendered, layouts.values()):
+            for output_path, graph_data in outputs:
+                if error:
+                    failures.append((output_path, error))
+                elif graph_data is None:
+                    write(output_path, rendered_graph)
+                else:
+                    write(output_path, make_html(rendered_graph.decode("utf8"), graph_data))
+    return written, failures
+
+
+class StreamCommandTests(unittest.TestCase):
+
+    def test_lines_arrive_as_they_are_output(self):
+        started = time.time()
+        lines = stream_command("echo first; sleep 2; echo second")
+        self.assertEqual(next(lines), "first")
+        self.assertLess(time.time() - started, 1.5)
+        self.assertEqual(list(lines), ["second"])
+
+    def test_commands_are_killed_on_timeout(self):
+        started = time.time()
+        with self.assertRaises(SourceTimeout):
+            list(stream_command("echo first; sleep 10", timeout=0.2))
+        self.assertLess(time.time() - started, 5)
+
+
+class RenderCacheTests(unittest.TestCase):
+
+    def test_least_recently_used_renders_are_forgotten(self):
+        cache = RenderCache(max_entries=2)
+        cache.put("a", b"A")
+        cache.put("b", b"B")
+        self.assertEqual(cache.get("a"), b"A")
+        cache.put("c", b"C")
+
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), b"A")
+        self.assertEqual(cache.stats()["memory_hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_disk_tier(self):
+        directory = tempfile.mkdtemp()
+        cache = RenderCache(max_entries=1, directory=directory, max_disk_bytes=10)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        os.utime(os.path.join(directory, "a.render"), (0, 0))
+        cache.put("c", b"cccc")
+
+        # a is the oldest file, so it's evicted to stay within 10 bytes
+        self.assertEqual(sorted(os.listdir(directory)), ["b.render", "c.render"])
+        self.assertEqual(RenderCache(directory=directory).get("b"), b"bbbb")
+
+    def test_only_renders_are_evicted(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "my-notes.txt"), "w") as f:
+            f.write("Not a render, and older and bigger than any")
+        os.utime(os.path.join(directory, "my-notes.txt"), (0, 0))
+
+        cache = RenderCache(max_entries=1, directory=directory, max_disk_bytes=10)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        cache.put("c", b"cccc")
+        self.assertEqual(sorted(os.listdir(directory)), ["b.render", "c.render", "my-notes.txt"])
+
+    def test_disk_entries_can_vanish(self):
+        directory = tempfile.mkdtemp()
+        cache = RenderCache(max_entries=1, directory=directory)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+
+        # Another process evicts a between the existence check and the read
+        exists = os.path.exists
+        def evicting_exists(path):
+            result = exists(path)
+            if path == os.path.join(directory, "a.render") and result:
+                os.remove(path)
+            return result
+        os.path.exists = evicting_exists
+        try:
+            self.assertEqual(cache.get("a"), None)
+        finally:
+            os.path.exists = exists
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(os.listdir(directory), ["b.render"])
+
+    def test_renders_are_reused(self):
+        cache = RenderCache()
+        cache.put(cache.key(b"digraph G {}", "dot", "svg", *graphviz_args("svg")), b"<svg/>")
+
+        # Graphviz isn't invoked for a render that's cached
+        self.assertEqual(make_graph_from_dot(b"digraph G {}", cache=cache), b"<svg/>")
+
+
+class LayoutServiceTests(unittest.TestCase):
+    # Any program can stand in for Graphviz
+
+    def test_output(self):
+        self.assertEqual(LayoutService().run(b"digraph {}", "cat", []), b"digraph {}")
+        self.assertEqual(LayoutService().run(iter([b"digraph ", b"{}"]), "cat", []), b"digraph {}")
+
+    def test_errors_making_blocks(self):
+        def blocks():
+            yield b"digraph {"
+            raise ValueError("no more")
+
+        # The program's input ends, rather than leaving it waiting for the rest
+        started = time.time()
+        with self.assertRaises(ValueError):
+            LayoutService().run(blocks(), "cat", [], timeout=10)
+        self.assertLess(time.time() - started, 5)
+
+        # Graphs that can't be rendered raise before anything's read
+        graph = Graph.from_string("..subgraph: a: b\n..subgraph: b: a\na --> b")
+        self.assertRaises(ValueError, graph.iter_dot)
+
+    def test_concurrency_is_bounded(self):
+        service = LayoutService(workers=2)
+        started = time.time()
+        pool = ThreadPool(4)
+        pool.map(lambda _: service.run(b"", "sleep", ["0.3"]), range(4))
+        pool.close()
+        self.assertGreater(time.time() - started, 0.55)
+        self.assertEqual(service.stats()["completed"], 4)
+        self.assertEqual(service.stats()["running"], 0)
+
+    def test_timeouts(self):
+        service = LayoutService(workers=1, timeout=0.3)
+        started = time.time()
+        self.assertRaises(LayoutTimeout, service.run, b"", "sleep", ["5"])
+        self.assertLess(time.time() - started, 2)
+
+        # Waiting for a worker counts too
+        busy = threading.Thread(target=service.run, args=(b"", "sleep", ["1"]), kwargs={"timeout": 5})
+        busy.start()
+        self.addCleanup(busy.join)
+        time.sleep(0.1)
+        started = time.time()
+        self.assertRaises(LayoutTimeout, service.run, b"", "sleep", ["0"], timeout=0.2)
+        self.assertLess(time.time() - started, 0.8)
+        self.assertEqual(service.stats()["timeouts"], 2)
+
+
+class StageTimingsTests(unittest.TestCase):
+
+    def test_stages_and_counts(self):
+        timings = StageTimings()
+        with timings.stage("parse"):
+            self.assertEqual(list(counted(iter(["a --> b", "b --> c"]), timings, "lines")), ["a --> b", "b --> c"])
+        with timings.stage("dot"):
+            pass
+        self.assertEqual(list(timings.seconds), ["parse", "dot"])
+        self.assertEqual(timings.counts, {"lines": 2})
+        self.assertTrue(re.match(r"^parse;dur=[0-9.]+, dot;dur=[0-9.]+$", timings.server_timing()))
+
+    def test_cumulative_histograms(self):
+        metrics = StageMetrics()
+        for seconds in (0.001, 0.2, 100):
+            timings = StageTimings()
+            timings.seconds["layout"] = seconds
+            timings.count("nodes", 3)
+            metrics.observe("abc", timings)
+
+        text = metrics.render(RenderCache())
+        self.assertIn('graphspec_stage_seconds_bucket{profile="abc",stage="layout",le="0.005"} 1', text)
+        self.assertIn('graphspec_stage_seconds_bucket{profile="abc",stage="layout",le="0.25"} 2', text)
+        self.assertIn('graphspec_stage_seconds_bucket{profile="abc",stage="layout",le="+Inf"} 3', text)
+        self.assertIn('graphspec_stage_seconds_count{profile="abc",stage="layout"} 3', text)
+        self.assertIn('graphspec_last_count{profile="abc",what="nodes"} 3', text)
+        self.assertIn('graphspec_render_cache{what="misses"} 0', text)
+
+
+@unittest.skipUnless(installed("rg"), "ripgrep is not installed")
+class PathsSourceTests(unittest.TestCase):
+
+    def test_only_changed_files_are_searched_again(self):
+        directory = tempfile.mkdtemp()
+        for name, content in (("a.md", "a --> b\n"), ("c.md", "..attr: c: color=red\n")):
+            with open(os.path.join(directory, name), "w") as f:
+                f.write(content)
+
+        source = PathsSource([directory])
+        self.assertEqual(len(source.refresh()), 2)
+        self.assertEqual(source.refresh(), [])
+
+        with open(os.path.join(directory, "a.md"), "w") as f:
+            f.write("a --> b\nb --> c :: New!\n")
+        os.utime(os.path.join(directory, "a.md"), (0, 0))
+
+        self.assertEqual(source.refresh(), [os.path.join(directory, "a.md")])
+        self.assertEqual(source.statements(), [
+            {"start": "a", "end": "b"},
+            {"start": "b", "end": "c", "comment": "New!"},
+            {"directive": "attr", "node": "c", "data": "color=red"},
+        ])
+
+    def test_globs_are_expanded(self):
+        directory = tempfile.mkdtemp()
+        for name in ("a.md", "b.md", "c.txt"):
+            with open(os.path.join(directory, name), "w") as f:
+                f.write("{} --> z\n".format(name[0]))
+
+        source = PathsSource([os.path.join(directory, "*.md")])
+        self.assertEqual(sorted(source.refresh()), [os.path.join(directory, "a.md"), os.path.join(directory, "b.md")])
+
+    def test_missing_paths_leave_the_rest(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "a.md"), "w") as f:
+            f.write("a --> b\n")
+
+        source = PathsSource([directory, os.path.join(directory, "missing"), os.path.join(directory, "*.txt")])
+        self.assertEqual(source.statements(), [{"start": "a", "end": "b"}])
+
+    def test_timeouts_cover_the_whole_refresh(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "a.md"), "w") as f:
+            f.write("a --> b\n")
+
+        source = PathsSource([directory])
+        with self.assertRaises(SourceTimeout):
+            source.statements(timeout=0)
+        self.assertEqual(source.statements(timeout=60), [{"start": "a", "end": "b"}])
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_corpus_is_deterministic(self):
+        corpus = list(synthetic_corpus(200, seed=3))
+        self.assertEqual(corpus, list(synthetic_corpus(200, seed=3)))
+        self.assertNotEqual(corpus, list(synthetic_corpus(200, seed=4)))
+
+    def test_noise_has_no_statements(self):
+        for line in NOISE_LINES:
+            self.assertEqual(list(iter_statements([line])), [], line)
+            self.assertEqual(list(iter_statements([line], engine="pyparsing")), [], line)
+
+    def test_corpus_makes_a_renderable_graph(self):
+        graph = Graph.from_lines(synthetic_corpus(500, subgraph_depth=2, fanout=3))
+        self.assertGreater(graph.core.number_of_edges(), 400)
+        self.assertIn("subgraph cluster_g0_g1", graph.render_dot())
+        self.assertTrue(graph.core.is_forest())
+        self.assertEqual(graph.core.parent_of(graph.core.children_of("g0.g1")[-1]), "g0.g1")
+
+    def test_compare_against_baseline(self):
+        results = run_benchmarks(scales=[100], repeat=1)
+        self.assertEqual(compare_benchmarks(results, results), [])
+
+        baseline = json.loads(json.dumps(results))
+        baseline["scales"]["100"]["seconds"]["from_lines"] = results["scales"]["100"]["seconds"]["from_lines"] / 2
+        self.assertEqual([stage for _, stage, _, _ in compare_benchmarks(results, baseline)], ["from_lines"])
+
+        baseline = json.loads(json.dumps(results))
+        baseline["startup"]["seconds"]["dot"] = results["startup"]["seconds"]["dot"] / 2
+        self.assertEqual(compare_benchmarks(results, baseline), [("startup", "dot", baseline["startup"]["seconds"]["dot"], results["startup"]["seconds"]["dot"])])
+
+    def test_startup_only_imports_what_it_needs(self):
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys; sys.path.insert(0, sys.argv[1]); import graphspec; print(' '.join(sorted(sys.modules)))",
+            os.path.dirname(os.path.realpath(__file__))
+        ])
+        modules = set(output.decode("utf8").split())
+        for module in ("flask", "werkzeug", "jinja2", "networkx", "pyparsing", "sh", "yaml"):
+            self.assertNotIn(module, modules)
+
+
+class SnapshotsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.builds = []
+        self.policy = (0, None, None)
+        self.snapshots = Snapshots(self.build, lambda key: self.policy)
+
+    def build(self, key):
+        self.builds.append(key)
+        time.sleep(0.1)
+        html = "{} #{}".format(key, len(self.builds))
+        return Snapshot(None, html, "", {}, "", time.time(), html, {})
+
+    def test_stale_snapshots_are_served_while_rebuilt(self):
+        self.assertEqual(self.snapshots.get("a").html, "a #1")
+
+        started = time.time()
+        self.assertEqual(self.snapshots.get("a").html, "a #1")
+        self.assertLess(time.time() - started, 0.05)
+        time.sleep(0.3)
+        self.assertEqual(self.snapshots.get("a").html, "a #2")
+
+    def test_fresh_snapshots_are_served_as_is(self):
+        self.policy = (60, None, None)
+        self.snapshots.get("a")
+        self.snapshots.get("a")
+        time.sleep(0.2)
+        self.assertEqual(self.builds, ["a"])
+
+    def test_too_stale_snapshots_are_waited_for(self):
+        self.policy = (0, 0, None)
+        self.snapshots.get("a")
+        self.assertEqual(self.snapshots.get("a").html, "a #2")
+
+    def test_current_snapshots_are_never_revalidated(self):
+        self.policy = (0, 0, None)
+        self.assertEqual(self.snapshots.current("a").html, "a #1")
+        self.assertEqual(self.snapshots.current("a").html, "a #1")
+        self.assertEqual(self.builds, ["a"])
+
+    def test_concurrent_requests_share_a_build(self):
+        pool = ThreadPool(4)
+        self.assertEqual(set(snapshot.html for snapshot in pool.map(self.snapshots.get, ["a"] * 4)), set(["a #1"]))
+        pool.terminate()
+
+    def test_updates(self):
+        self.snapshots.get("a")
+        updates = self.snapshots.updates("a", timeout=0.05)
+        self.assertEqual(next(updates), None)
+        self.snapshots.rebuild_matching(lambda key: key == "a")
+        self.assertEqual(next(update for update in updates if update).html, "a #2")
+
+        # Nothing new is still said, after a rebuild into the same thing, and after eviction
+        self.snapshots.build = lambda key: self.build(key)._replace(etag="a #2")
+        self.snapshots.rebuild("a")
+        started = time.time()
+        self.assertEqual(next(updates), None)
+        self.assertEqual(next(updates), None)
+        with self.snapshots.lock:
+            del self.snapshots.snapshots["a"]
+        self.assertEqual(next(updates), None)
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_file_changes_only_rebuild_what_is_wanted(self):
+        self.policy = (60, None, None)
+        self.snapshots.get("a")
+        self.snapshots.get("b")
+        updates = self.snapshots.updates("b", timeout=0.05)
+        next(updates)
+
+        # Nobody's asked for a in a while, but someone's listening to b
+        self.snapshots.idle_after = 0
+        time.sleep(0.01)
+        self.snapshots.rebuild_matching(lambda key: True)
+        self.assertEqual(next(update for update in updates if update).html, "b #3")
+        self.assertEqual(self.builds, ["a", "b", "b"])
+        self.assertNotIn("a", self.snapshots.snapshots)
+
+        updates.close()
+        self.assertEqual(self.snapshots.listeners, {})
+
+    def test_refresh(self):
+        self.policy = (60, None, 0.1)
+        self.snapshots.get("a")
+        self.snapshots.refresh_due()
+        self.assertEqual(self.builds, ["a"])
+        time.sleep(0.1)
+        self.snapshots.refresh_due()
+        time.sleep(0.2)
+        self.assertEqual(self.builds, ["a", "a"])
+
+        # Snapshots nobody's asked for in a while aren't refreshed
+        self.snapshots.idle_after = 0
+        time.sleep(0.1)
+        self.snapshots.refresh_due()
+        time.sleep(0.2)
+        self.assertEqual(self.builds, ["a", "a"])
+
+    def test_stale_pages_are_opt_in(self):
+        self.addCleanup(profiles.clear)
+        profiles.update(plain={}, lazy={"max_age": 10, "stale_while_revalidate": 300})
+        self.assertEqual(snapshot_policy(("plain", ())), (0, 0, None))
+        self.assertEqual(snapshot_policy(("lazy", ())), (10, 300, None))
+        self.assertEqual(snapshot_policy(("plain,lazy", ())), (0, 0, None))
+
+    def test_least_recently_used_snapshots_are_forgotten(self):
+        self.policy = (60, None, None)
+        self.snapshots.max_entries = 2
+        for key in ["a", "b", "a", "c", "a", "b"]:
+            self.snapshots.get(key)
+        self.assertEqual(self.builds, ["a", "b", "c", "b"])
+        self.assertEqual(list(self.snapshots.snapshots), ["a", "b"])
+
+
+class FileWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        with open(os.path.join(self.directory, "a.md"), "w") as f:
+            f.write("a --> b\n")
+
+    def assertWatches(self, watcher, changes):
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        time.sleep(0.3)
+        # Several writes in a row are one change
+        for i in range(3):
+            with open(os.path.join(self.directory, "a.md"), "a") as f:
+                f.write("b --> c{}\n".format(i))
+        with open(os.path.join(self.directory, "new.md"), "w") as f:
+            f.write("c --> d\n")
+        time.sleep(1.5)
+        self.assertEqual(len(changes), 1)
+
+    def test_inotify(self):
+        changes = []
+        watcher = FileWatcher([self.directory], lambda: changes.append(True), debounce=0.2, poll_interval=10)
+        if not watcher.inotify:
+            self.skipTest("inotify is not available")
+        self.assertWatches(watcher, changes)
+
+    def test_home_and_variables_are_expanded(self):
+        environ = dict(os.environ)
+        self.addCleanup(lambda: (os.environ.clear(), os.environ.update(environ)))
+        os.environ.update(HOME=self.directory, DOCS=self.directory)
+        for pattern in ("~/*.md", "$DOCS"):
+            watcher = FileWatcher([pattern], lambda: None, use_inotify=False)
+            self.assertEqual(list(watcher.files()), [os.path.join(self.directory, "a.md")])
+
+    def test_polling(self):
+        changes = []
+        watcher = FileWatcher([os.path.join(self.directory, "*.md")], lambda: changes.append(True), debounce=0.2,
+                              poll_interval=0.1, use_inotify=False)
+        self.assertWatches(watcher, changes)
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        with open(os.path.join(self.directory, "input.md"), "w") as f:
+            f.write("Some docs with a --> b in them\n..attr: b: color=red\n")
+        profiles.clear()
+        profiles["abc"] = {"shell": "echo 'a --> b, b --> c'"}
+
+    def test_outputs(self):
+        manifest = {
+            "output_dir": "out",
+            "formats": ["dot", "json"],
+            "graphs": [
+                {"name": "abc", "profile": "abc"},
+                {"name": "input", "input": "input.md", "formats": ["dot", "svg"], "engines": ["dot", "neato"]},
+            ]
+        }
+        written, failures = run_batch(manifest, self.directory)
+
+        out = os.path.join(self.directory, "out")
+        layouts = ["input.dot.svg", "input.neato.svg"]
+        self.assertEqual(sorted(os.path.relpath(path, out) for path in written), sorted(
+            ["abc.dot", "abc.json", "input.dot"] + (layouts if installed("dot") else [])
+        ))
+        # Without Graphviz, the layouts fail without holding up the rest
+        self.assertEqual(sorted(os.path.relpath(path, out) for path, _ in failures), [] if installed("dot") else layouts)
+        self.assertEqual(sorted(json.load(open(os.path.join(out, "abc.json")))["edges"]["a"]), ["b"])
+        self.assertIn("color=red", open(os.path.join(out, "input.dot")).read().decode("utf8"))
+
+    def test_json_is_the_same_with_html(self):
+        for formats in (["json"], ["json", "html"]):
+            run_batch({"graphs": [{"name": "abc", "profile": "abc", "formats": formats}]}, self.directory)
+            graph_data = json.load(open(os.path.join(self.directory, "abc.json")))
+            self.assertNotIn("closure_encoding", graph_data)
+            self.assertEqual(sorted(graph_data["transitive_closure"]["a"]), ["b", "c"])
+
+    def test_profiles_are_read_once_and_failures_are_per_graph(self):
+        # Shell commands run in the batch's directory
+        profiles["counted"] = {"shell": "echo run >> runs; cat input.md"}
+        manifest = {
+            "formats": ["dot"],
+            "graphs": [
+                {"name": "one", "profile": "counted"},
+                {"name": "two", "profile": "counted", "transitive_reduction": True},
+                {"name": "missing", "profile": "nope", "formats": ["dot", "svg"], "engines": ["dot", "neato"]},
+            ]
+        }
+        written, failures = run_batch(manifest, self.directory)
+
+        self.assertEqual(sorted(os.path.basename(path) for path in written), ["one.dot", "two.dot"])
+        self.assertIn("color=red", open(os.path.join(self.directory, "two.dot")).read().decode("utf8"))
+        self.assertEqual(open(os.path.join(self.directory, "runs")).read(), "run\n")
+        self.assertEqual(sorted(os.path.basename(path) for path, _ in failures), ["missing.dot", "missing.dot.svg", "missing.neato.svg"])
+        self.assertEqual(failures[0][1], "KeyError: u'nope'")
+
+    def test_unknown_formats(self):
+        self.assertRaises(ValueError, run_batch, {"graphs": [{"name": "abc", "profile": "abc", "formats": ["gif"]}]}, self.directory)
+
+
+class ServeTests(unittest.TestCase):
+
+    def setUp(self):
+        profiles.clear()
+        snapshots.clear()
+        profiles["abc"] = {"shell": "echo 'a --> b, b --> c'"}
+        self.client = get_app().test_client()
+
+    def cache_layout(self, graph):
+        """ Puts a layout of graph in the render cache, so its pages are made without Graphviz. """
+        render_cache.put(render_cache.key(graph.render_dot().encode("utf8"), "dot", "svg", *graphviz_args("svg")), b"<svg/>")
+
+    def test_closure_queries(self):
+        self.cache_layout(graph_for_profiles(["abc"])[0])
+        response = self.client.get("/abc/descendants/a")
+        self.assertEqual(json.loads(response.data.decode("utf8"))["nodes"], ["b", "c"])
+
+        response = self.client.get("/abc/ancestors/c")
+        self.assertEqual(json.loads(response.data.decode("utf8"))["nodes"], ["a", "b"])
+
+        self.assertEqual(self.client.get("/abc/ancestors/nope").status_code, 404)
+        self.assertEqual(self.client.get("/nope/ancestors/a").status_code, 404)
+
+    def test_closure_queries_of_collapsed_pages(self):
+        profiles["x"] = {"shell": "printf 'a --> x1, x1 --> x2\\n..subgraph: x: x1, x2\\n'"}
+        self.cache_layout(collapsed_graph(graph_for_profiles(["x"])[0], collapse_depth=0))
+
+        html = self.client.get("/x?collapse_depth=0").data.decode("utf8")
+        graph_data = json.loads(re.search(r"var graph = (.*);", html).group(1))
+        self.assertEqual(graph_data["collapsed"], {"x": 2})
+
+        # Clicking a node asks about what's on the page, not what's collapsed away
+        def click(direction, node):
+            response = self.client.get("{}/{}/{}?{}".format(graph_data["closure_url"], direction, node, graph_data["closure_query"]))
+            return response.status_code, json.loads(response.data.decode("utf8"))["nodes"] if response.status_code == 200 else None
+
+        self.assertEqual(click("descendants", "a"), (200, ["x"]))
+        self.assertEqual(click("ancestors", "x"), (200, ["a"]))
+        self.assertEqual(click("descendants", "x1"), (404, None))
+
+    def test_clicks_do_not_rebuild_pages(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        runs = os.path.join(directory, "runs")
+        profiles["abc"]["shell"] = "echo run >> {}; echo 'a --> b, b --> c'".format(runs)
+        self.cache_layout(graph_for_profiles(["abc"])[0])
+
+        self.client.get("/abc")
+        for _ in range(3):
+            self.assertEqual(self.client.get("/abc/descendants/a").status_code, 200)
+        # Once for the layout, and once for the page
+        self.assertEqual(len(open(runs).readlines()), 2)
+
+    def test_metrics(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE graphspec_stage_seconds histogram", response.data.decode("utf8"))
+        self.assertIn('graphspec_layouts{what="running"} 0', response.data.decode("utf8"))
+
+    def test_pages_are_compressed_and_revalidated(self):
+        profiles["abc"]["max_age"] = 60
+        self.cache_layout(graph_for_profiles(["abc"])[0])
+
+        response = self.client.get("/abc", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        html = zlib.decompress(response.data, 16 + zlib.MAX_WBITS)
+        self.assertIn(b"<svg/>", html)
+        etag = response.headers["ETag"]
+        # The page has its timings in it, so it's only the same page as other builds, not the same bytes
+        self.assertTrue(etag.startswith('W/"'))
+
+        response = self.client.get("/abc", headers={"If-None-Match": etag, "Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response.headers["ETag"], etag)
+
+        # The uncompressed page has an ETag of its own
+        response = self.client.get("/abc", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.data, html)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        # Rebuilding the same page keeps its weak ETag, though its timings change
+        snapshots.clear()
+        response = self.client.get("/abc", headers={"If-None-Match": etag, "Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 304)
+
+    def test_bad_expansions(self):
+        self.assertEqual(self.client.get("/abc/expand").status_code, 400)
+        self.assertEqual(self.client.get("/abc/expand?node=nope").status_code, 404)
+        self.assertEqual(self.client.get("/nope/expand?node=a").status_code, 404)
+        self.assertEqual(self.client.get("/abc/expand?node=a").status_code, 400)
+        self.assertEqual(self.client.get("/nope/expand?node=a").status_code, 404)
+
+    def test_bad_focus_views(self):
+        self.assertEqual(self.client.get("/abc?focus=nope").status_code, 404)
+        self.assertEqual(self.client.get("/abc?between=a").status_code, 400)
+        self.assertEqual(self.client.get("/abc?focus=a&direction=sideways").status_code, 400)
+
+    def test_slow_sources_time_out_without_holding_up_others(self):
+        profiles["slow"] = {"shell": "sleep 5; echo 'x --> y'", "timeout": 0.5}
+        started = time.time()
+        statements, reports = fetch_profiles(["slow", "abc"])
+
+        self.assertLess(time.time() - started, 4)
+        self.assertEqual(statements, [[], [{"start": "a", "end": "b"}, {"start": "b", "end": "c"}]])
+        self.assertEqual(reports[0].error, "timed out after 0.5 seconds")
+        self.assertEqual(reports[1].error, None)
 
 
 def main():
+    global source_workers, source_timeout
     parser = argparse.ArgumentParser(description='')
     parser.add_argument("--test", help="Runs tests", action="store_true")
     parser.add_argument("--dot", help="Emit the Graphviz data without further processing", action="store_true")
@@ -553,19 +4036,46 @@ def main():
     parser.add_argument("--svg", help="Output an SVG", action="store_true")
     parser.add_argument("--html", help="Output an HTML", action="store_true")
     parser.add_argument("--json", help="Output a JSON dump of the graph data", action="store_true")
+    parser.add_argument("--transitive-reduction", help="Leave out edges that are implied by other paths", action="store_true")
+    parser.add_argument("--compact-closure", help="Encode the transitive closure in the JSON output as lists of node positions", action="store_true")
+    parser.add_argument("--cache-dir", help="Also keep rendered graphs in this directory", action="store")
+    parser.add_argument("--cache-size", help="Megabytes of renders to keep in --cache-dir", action="store", type=int, default=256)
     parser.add_argument("--serve", help="Start an HTTP server", action="store_true")
     parser.add_argument("--port", help="Port to bind to, if serving", action="store", default="8008")
     parser.add_argument("--host", help="Host to bind to, if serving", action="store", default="127.0.0.1")
     parser.add_argument("--profile", help="Profiles to serve, if serving", action="store")
+    parser.add_argument("--source-workers", help="How many profile sources to fetch at once, if serving", action="store", type=int, default=4)
+    parser.add_argument("--source-timeout", help="Seconds to wait for a profile's source, if serving", action="store", type=float, default=60)
+    parser.add_argument("--layout-workers", help="How many layouts to run at once, by default one per core", action="store", type=int)
+    parser.add_argument("--layout-timeout", help="Seconds a layout may take, waiting for a worker included, if serving", action="store", type=float, default=60)
     parser.add_argument("--type", help="Graph type: dot, neato, or fdp", action="store", default="dot")
+    parser.add_argument("--positions", help="Keep neato and fdp node positions in this file, so the next layout keeps nodes where they were", action="store")
     parser.add_argument("--include-everything", help="Include nodes with no in- or outputs?", action="store_true")
+    parser.add_argument("--focus", help="Only show the graph around this node", action="store")
+    parser.add_argument("--depth", help="How many edges away from --focus to go, by default all the way", action="store", type=int)
+    parser.add_argument("--direction", help="Which way to go from --focus", action="store", default="both", choices=FOCUS_DIRECTIONS)
+    parser.add_argument("--collapse-depth", help="Show each subgraph this many levels down as a single node", action="store", type=int)
+    parser.add_argument("--node-budget", help="Collapse subgraphs as far down as it takes to show at most this many nodes", action="store", type=int)
+    parser.add_argument("--between", help="Only show the paths between two comma-separated nodes", action="store")
+    parser.add_argument("--benchmark", help="Time the stages of making graphs of synthetic inputs, and output the results as JSON", action="store_true")
+    parser.add_argument("--benchmark-scales", help="Comma-separated numbers of edges to benchmark", action="store", default=",".join(str(scale) for scale in BENCHMARK_SCALES))
+    parser.add_argument("--benchmark-baseline", help="JSON results of an earlier --benchmark, to compare against", action="store")
+    parser.add_argument("--batch", help="Make all the outputs a YAML or JSON manifest lists, see run_batch()", action="store")
+    parser.add_argument("--profile-stages", help="Print how long each stage took to stderr", action="store_true")
+    parser.add_argument("--jobs", help="Parse input with this many processes, 0 for one per core", action="store", type=int, default=1)
+    parser.add_argument("--parser", help="Statement parser: scanner, or the slower reference pyparsing grammar", action="store", default="scanner", choices=sorted(statement_engines))
 
     args = parser.parse_args()
     
-    if not any((args.dot, args.pdf, args.png, args.svg, args.html, args.json, args.serve, args.test)):
+    if not any((args.dot, args.pdf, args.png, args.svg, args.html, args.json, args.serve, args.test, args.benchmark, args.batch)):
         parser.print_help()
         return
 
+    if args.cache_dir:
+        render_cache.use_directory(args.cache_dir, args.cache_size * 1024 * 1024)
+    if args.layout_workers:
+        layout_service.workers = args.layout_workers
+
     if args.test:
         import doctest
         doctest.testmod(raise_on_error=True)
@@ -573,32 +4083,129 @@ def main():
         unittest.main(verbosity=2)
         return
 
+    elif args.benchmark:
+        logging.basicConfig(level=logging.INFO)
+        results = run_benchmarks([int(scale) for scale in args.benchmark_scales.split(",")])
+        print(json.dumps(results, indent=4))
+        if args.benchmark_baseline:
+            regressions = compare_benchmarks(results, json.load(open(args.benchmark_baseline)))
+            for scale, stage, baseline_seconds, seconds in regressions:
+                print("{} at {} edges: {:.3f}s, was {:.3f}s".format(stage, scale, seconds, baseline_seconds), file=sys.stderr)
+            if regressions:
+                sys.exit(1)
+        return
+
+    elif args.batch:
+        import yaml
+        timings = StageTimings()
+        try:
+            written, failures = run_batch(yaml.safe_load(open(args.batch)), os.path.dirname(args.batch), timings)
+        finally:
+            if args.profile_stages:
+                print(timings.report(), file=sys.stderr)
+        for path in written:
+            print(path)
+        for path, error in failures:
+            print("Could not make {}: {}".format(path, error), file=sys.stderr)
+        if failures:
+            sys.exit(1)
+        return
+
     elif args.serve:
         import yaml
         print("Starting to serve up profiles from [{}]".format(args.profile))
         print("Warning: Don't assume this service is safe to run on a public interface.")
         print("Warning: Note that anyone that can edit the profile file can run arbitrary code.")
         profiles.update(yaml.safe_load(open(args.profile)))
-        app.run(host=args.host, port=int(args.port))
+        source_workers, source_timeout = args.source_workers, args.source_timeout
+        layout_service.timeout = args.layout_timeout
+        # Every page inlines these, so they're read now rather than for each page
+        for name in ("graphspec.js", "graphspec.css"):
+            static_file_contents(name)
+        snapshots.refresh_periodically()
+        watch_profiles()
+        # Requests are mostly served from snapshots, which mustn't wait for others being built
+        get_app().run(host=args.host, port=int(args.port), threaded=True)
         return
 
+    timings = StageTimings()
+    try:
+        render_stdin(args, parser, timings)
+    finally:
+        if args.profile_stages:
+            print(timings.report(), file=sys.stderr)
+
+
+def render_stdin(args, parser, timings):
+    """ Writes the graph read from stdin to stdout, in the format args ask for. """
     # We'll be wanting a graph
-    graph = Graph.from_string(sys.stdin.read().decode("utf8"), include_everything=args.include_everything)
-    dot = graph.render_dot().encode("utf8")
-    graph_data = graph.get_graph_data()
+    graph = Graph(include_everything=args.include_everything)
+    with timings.stage("parse"):
+        lines = counted(iter_lines(sys.stdin), timings, "lines")
+        graph.include_statements(counted(parse_lines(lines, args.parser, args.jobs), timings, "statements"))
+    try:
+        with timings.stage("focus"):
+            graph = focused_graph(graph, args.focus, args.depth, args.direction, args.between)
+        with timings.stage("collapse"):
+            graph = collapsed_graph(graph, args.collapse_depth, args.node_budget)
+    except (LookupError, ValueError) as e:
+        parser.error(e.args[0])
+    timings.count("nodes", len(graph.core))
+    timings.count("edges", graph.core.number_of_edges())
+
+    if args.transitive_reduction:
+        with timings.stage("transitive_reduction"):
+            graph.redundant_edges()
+    incremental = args.positions and args.type in INCREMENTAL_LAYOUT_ENGINES
+    if incremental:
+        layout_memory.load(args.positions)
+    positions = layout_memory.recall("graph", graph) if incremental else None
+
+    def counted_block(block):
+        timings.count("dot_bytes", len(block))
+        return block
+
+    def dot_blocks():
+        # Not a generator, so iter_dot checks the graph here rather than once Graphviz is reading it
+        return (counted_block(block) for block in encoded_blocks(graph.iter_dot(args.transitive_reduction, positions)))
+
+    # Renders only outlive this run in a cache directory. Without one, the DOT goes straight to where
+    # it's going as it's made, so all of it is never held at once.
+    streaming = not (incremental or render_cache.directory)
+    if not streaming:
+        with timings.stage("dot"):
+            dot = b''.join(dot_blocks())
 
     if args.dot:
         # Just the dot please
-        print(dot)
+        with timings.stage("dot"):
+            for block in dot_blocks() if streaming else [dot]:
+                sys.stdout.write(block)
+        print()
         return
-    elif args.json:
+
+    def graph_data():
+        # Only JSON and HTML have it, and with the closure it can take longer than the rest
+        with timings.stage("graph_data"):
+            # The HTML page decodes the compact closure itself
+            return graph.get_graph_data(compact_closure=args.compact_closure or args.html, apply_transitive_reduction=args.transitive_reduction)
+
+    if args.json:
         # The JSON can be useful to e.g. run tests on
-        print(json.dumps(graph_data, indent=4))
+        print(json.dumps(graph_data(), indent=4))
         return
 
     # At this point we'll be invoking graphviz to generate a graph
     format = (args.pdf and 'pdf') or (args.png and 'png') or 'svg'
-    rendered_graph = make_graph_from_dot(dot, args.type, format)
+    with timings.stage("layout"):
+        if incremental:
+            rendered_graph, positions = make_incremental_graph_from_dot(dot, args.type, format)
+            layout_memory.remember("graph", graph, positions)
+            layout_memory.save(args.positions)
+        else:
+            # When streaming, the DOT's made as the layout reads it
+            rendered_graph = make_graph_from_dot(dot_blocks() if streaming else dot, args.type, format)
+    timings.count("{}_bytes".format(format), len(rendered_graph))
 
     if args.pdf or args.svg or args.png:
         # We just want the graph
@@ -608,7 +4215,11 @@ def main():
     assert args.html
     # At this point we want a self-contained HTML file
     svg = rendered_graph.decode("utf8")
-    print(make_html(svg, graph_data))
+    data = graph_data()
+    with timings.stage("html"):
+        html = make_html(svg, data)
+    timings.count("html_bytes", len(html))
+    print(html)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file